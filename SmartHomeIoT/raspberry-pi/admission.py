@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Admission control for the SmartHome Pi services
+
+Keeps one misbehaving client from taking the whole Pi down:
+
+- token-bucket rate limits per client and endpoint (429 + Retry-After)
+- a cap on concurrent streams / long-polls (503 + Retry-After)
+- a cap on other requests in progress, so overload fails fast (503)
+  instead of queueing until clients time out
+- a priority lane: health checks and state reads skip both caps (and in
+  --async mode run on their own worker thread), so they are always served
+
+Usage:
+    admission = AdmissionControl(
+        limits=[('POST', '/led', 5, 10)],   # method, path ('*' suffix = prefix), rate/s, burst
+        priority=['/health', '/led'],      # GET/HEAD only
+        streams=['/events*'],
+        exempt=['127.0.0.1'],              # clients without rate limits
+        max_streams=50, max_requests=16)
+    install_flask(admission, app)            # threaded mode
+    AsyncServer(app, admission=admission)     # --async mode
+"""
+
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+EXEMPT_CLIENTS = ('127.0.0.1', '::1')  # Local services such as schedule_checker.py
+MAX_BUCKETS = 1024  # (client, endpoint) pairs remembered, least recently used are dropped
+STREAM_RETRY_AFTER = 5
+REQUEST_RETRY_AFTER = 1
+
+
+def path_matches(pattern, path):
+    """Exact match, or prefix match for patterns ending in '*'"""
+    if pattern.endswith('*'):
+        return path.startswith(pattern[:-1])
+    return path == pattern
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """0 if a token was taken, else seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionControl:
+    """Decides whether a request may run now (thread-safe)"""
+
+    def __init__(self, limits=(), priority=(), streams=(), max_streams=10, max_requests=16,
+                 exempt=EXEMPT_CLIENTS):
+        self.limits = list(limits)
+        self.exempt = set(exempt)
+        self.priority = list(priority)
+        self.streams = list(streams)
+        self.max_streams = max_streams
+        self.max_requests = max_requests
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # (client, method, path) -> TokenBucket
+        self.active_streams = 0
+        self.active_requests = 0
+        self.rejected = {'rate_limited': 0, 'streams_full': 0, 'busy': 0}
+
+    def is_priority(self, method, path):
+        return method in ('GET', 'HEAD') and any(path_matches(p, path) for p in self.priority)
+
+    def is_stream(self, path):
+        return any(path_matches(p, path) for p in self.streams)
+
+    def admit(self, client, method, path):
+        """None if the request may run (call release() when it ends),
+        otherwise (status, retry_after seconds, message) to reject it with"""
+        method = 'GET' if method == 'HEAD' else method
+        limits = self.limits if client not in self.exempt else ()
+        with self.lock:
+            for rule_method, pattern, rate, burst in limits:
+                if rule_method == method and path_matches(pattern, path):
+                    # One bucket per endpoint, so a catch-all rule doesn't make
+                    # a client's busy endpoint throttle its health checks
+                    key = (client, method, path)
+                    bucket = self.buckets.get(key)
+                    if bucket is None:
+                        bucket = self.buckets[key] = TokenBucket(rate, burst)
+                        if len(self.buckets) > MAX_BUCKETS:
+                            self.buckets.popitem(last=False)
+                    else:
+                        self.buckets.move_to_end(key)
+                    wait = bucket.take()
+                    if wait:
+                        self.rejected['rate_limited'] += 1
+                        return 429, wait, 'Too many requests'
+                    break
+
+            if self.is_stream(path):
+                if self.active_streams >= self.max_streams:
+                    self.rejected['streams_full'] += 1
+                    return 503, STREAM_RETRY_AFTER, 'Too many open streams'
+                self.active_streams += 1
+            elif not self.is_priority(method, path):
+                if self.active_requests >= self.max_requests:
+                    self.rejected['busy'] += 1
+                    return 503, REQUEST_RETRY_AFTER, 'Server busy'
+                self.active_requests += 1
+        return None
+
+    def release(self, method, path):
+        """A request admitted by admit() has finished"""
+        method = 'GET' if method == 'HEAD' else method
+        with self.lock:
+            if self.is_stream(path):
+                self.active_streams -= 1
+            elif not self.is_priority(method, path):
+                self.active_requests -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'active_streams': self.active_streams,
+                'max_streams': self.max_streams,
+                'active_requests': self.active_requests,
+                'max_requests': self.max_requests,
+                'rejected': dict(self.rejected)
+            }
+
+
+def rejection(status, retry_after, message):
+    """(body, headers) of a rejected request"""
+    retry_after = max(1, math.ceil(retry_after))
+    body = json.dumps({'error': message, 'retry_after': retry_after}).encode()
+    return body, {'Retry-After': str(retry_after), 'Content-Type': 'application/json'}
+
+
+def install_flask(admission, app):
+    """Check every request to a Flask app (threaded mode)"""
+    from flask import Response, g, request
+
+    @app.before_request
+    def admit_request():
+        if request.method == 'OPTIONS':
+            return None
+        rejected = admission.admit(request.remote_addr, request.method, request.path)
+        if rejected:
+            body, headers = rejection(*rejected)
+            return Response(body, status=rejected[0], headers=headers)
+        g.admitted = (request.method, request.path)
+        return None
+
+    @app.after_request
+    def release_request(response):
+        admitted = g.pop('admitted', None)
+        if admitted:
+            # Streams are released when the client goes away, not when the headers are sent
+            response.call_on_close(lambda: admission.release(*admitted))
+        return response
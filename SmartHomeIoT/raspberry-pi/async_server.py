@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+"""
+Minimal asyncio HTTP/1.1 server for the SmartHome Pi services
+
+Long-lived responses (MJPEG streams, long-polls) are served by coroutines
+registered with route(), so an idle connection costs a socket and a small
+task instead of an OS thread. Every other request is passed to the Flask
+app on a small fixed thread pool, so URLs and response formats stay the
+same as with app.run().
+
+Usage:
+    server = AsyncServer(app, threads=4)
+
+    @server.route('/camera/stream')
+    async def stream(request):
+        return AsyncResponse(frames(), content_type='multipart/x-mixed-replace; boundary=frame')
+
+    server.run('0.0.0.0', 8081)
+
+run() returns after SIGINT or SIGTERM once the server has shut down
+gracefully: it stops accepting, closes idle keep-alive connections and
+streams, and gives requests in progress SHUTDOWN_TIMEOUT to finish, so the
+caller's cleanup (GPIO, camera) still runs under systemd.
+"""
+
+import asyncio
+import io
+import json
+import logging
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, unquote_to_bytes
+
+from werkzeug.datastructures import MultiDict
+
+from admission import rejection
+
+logger = logging.getLogger(__name__)
+
+MAX_HEADER_SIZE = 16 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+KEEPALIVE_TIMEOUT = 15  # seconds an idle keep-alive connection stays open
+SHUTDOWN_TIMEOUT = 10  # seconds requests in progress get to finish on shutdown
+BACKLOG = 256
+
+
+class BadRequest(Exception):
+    """Unservable request, answered with `status` before the connection closes"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class Request:
+    """Parsed HTTP request (headers keyed by lower-case name)"""
+
+    def __init__(self, method, target, version, headers, body, remote_addr):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.remote_addr = remote_addr
+        self.path, _, self.query_string = target.partition('?')
+        self.args = MultiDict(parse_qsl(self.query_string, keep_blank_values=True))
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+class AsyncResponse:
+    """Result of an async route
+
+    `body` is bytes, or an async generator of bytes for a streamed response
+    (the connection is closed once a streamed body ends).
+    """
+
+    def __init__(self, body=b'', status=200, headers=None, content_type='text/plain'):
+        self.body = body
+        self.status = status
+        self.headers = dict(headers or {})
+        self.headers.setdefault('Content-Type', content_type)
+
+    @classmethod
+    def json(cls, data, status=200, headers=None):
+        return cls(json.dumps(data).encode(), status, headers, 'application/json')
+
+
+class Signal:
+    """Lets plain threads wake up coroutines waiting on the event loop"""
+
+    def __init__(self):
+        self.loop = None
+        self.future = None
+
+    def waiter(self):
+        """Future resolved by the next notify(); take it before checking state"""
+        if self.future is None:
+            self.loop = asyncio.get_running_loop()
+            self.future = self.loop.create_future()
+        return self.future
+
+    def notify(self):
+        """Wake every waiter (safe to call from any thread)"""
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        future, self.future = self.future, None
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def wait(self, timeout=None, waiter=None):
+        """Wait for the next notify(), False on timeout"""
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter or self.waiter()), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class AsyncServer:
+    """asyncio front end: async routes first, everything else through WSGI"""
+
+    def __init__(self, wsgi_app, threads=4, default_headers=None, admission=None):
+        self.app = wsgi_app
+        self.routes = {}
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        # Priority requests (see admission.py) get their own thread, so they never queue behind the pool
+        self.priority_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='priority')
+        self.admission = admission
+        self.default_headers = dict(default_headers or {})
+        self.connections = {}  # task -> 'idle', 'busy' or 'streaming'
+        self.stopping = None
+
+    def route(self, path, methods=('GET',)):
+        """Register a coroutine `handler(request) -> AsyncResponse` for a path"""
+        def decorator(handler):
+            for method in methods:
+                self.routes[(method, path)] = handler
+            return handler
+        return decorator
+
+    async def run_blocking(self, func, *args):
+        """Run a blocking call on the worker pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def serve(self, host, port):
+        """Serve until SIGINT/SIGTERM, then shut down gracefully"""
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stopping.set)
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_SIZE, backlog=BACKLOG)
+        logger.info(f"Async server listening on {host}:{port}")
+        try:
+            await self.stopping.wait()
+            logger.info("Shutting down...")
+            server.close()
+            await self.close_connections()
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+
+    async def close_connections(self):
+        """Close idle connections and streams, let busy requests finish first"""
+        for task, state in list(self.connections.items()):
+            if state != 'busy':
+                task.cancel()
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=SHUTDOWN_TIMEOUT)
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+    def run(self, host, port):
+        try:
+            asyncio.run(self.serve(host, port))
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.priority_executor.shutdown(wait=False, cancel_futures=True)
+
+    async def handle(self, reader, writer):
+        """Serve one connection, request after request while keep-alive holds"""
+        peer = writer.get_extra_info('peername')
+        remote_addr = peer[0] if peer else ''
+        task = asyncio.current_task()
+        try:
+            while not self.stopping.is_set():
+                self.connections[task] = 'idle'
+                try:
+                    request = await asyncio.wait_for(read_request(reader, remote_addr), KEEPALIVE_TIMEOUT)
+                except BadRequest as e:
+                    await self.send(writer, None, AsyncResponse.json({'error': str(e)}, e.status))
+                    break
+                self.connections[task] = 'busy'
+                if request is None or not await self.dispatch(request, writer):
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # Closed by shutdown; asyncio would log a cancelled connection task as an error
+            pass
+        except Exception:
+            logger.exception("Error while serving connection")
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+
+    async def dispatch(self, request, writer):
+        """Serve one request, True if the connection can be reused"""
+        method = 'GET' if request.method == 'HEAD' else request.method
+        if self.admission is None or method == 'OPTIONS':
+            return await self.route_request(method, request, writer)
+        rejected = self.admission.admit(request.remote_addr, method, request.path)
+        if rejected:
+            body, headers = rejection(*rejected)
+            return await self.send(writer, request, AsyncResponse(body, rejected[0], headers))
+        try:
+            return await self.route_request(method, request, writer)
+        finally:
+            self.admission.release(method, request.path)
+
+    async def route_request(self, method, request, writer):
+        handler = self.routes.get((method, request.path))
+        if handler is None:
+            return await self.call_wsgi(request, writer)
+        response = await handler(request)
+        return await self.send(writer, request, response)
+
+    async def send(self, writer, request, response):
+        """Write an AsyncResponse, True if the connection can be reused"""
+        streaming = not isinstance(response.body, (bytes, bytearray))
+        keep_alive = request is not None and request.keep_alive and not streaming and not self.stopping.is_set()
+        headers = dict(self.default_headers)
+        headers.update(response.headers)
+        if not streaming:
+            headers['Content-Length'] = str(len(response.body))
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+
+        writer.write(format_head(response.status, headers.items()))
+        if streaming:
+            # Streams never finish on their own, so shutdown closes them right away
+            self.connections[asyncio.current_task()] = 'streaming'
+            try:
+                async for chunk in response.body:
+                    writer.write(chunk)
+                    await writer.drain()
+            finally:
+                await response.body.aclose()
+        else:
+            if request is None or request.method != 'HEAD':
+                writer.write(response.body)
+            await writer.drain()
+        return keep_alive
+
+    async def call_wsgi(self, request, writer):
+        """Run the Flask app for a request on the worker pool"""
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        if self.admission and self.admission.is_priority(request.method, request.path):
+            executor = self.priority_executor
+        status, headers, body = await loop.run_in_executor(executor, self.run_wsgi, request)
+        header_names = {name.lower() for name, _ in headers}
+        # Werkzeug drops Content-Length from bodyless responses (e.g. 304), they need none to keep alive
+        no_body = bodyless(request.method, status)
+        keep_alive = (request.keep_alive and (no_body or 'content-length' in header_names)
+                      and not self.stopping.is_set())
+        headers = [(k, v) for k, v in self.default_headers.items() if k.lower() not in header_names] + headers
+        headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+
+        writer.write(format_head(status, headers))
+        try:
+            # Pull the body chunk by chunk so streamed responses never pile up in memory
+            while True:
+                chunk = await loop.run_in_executor(executor, next, body, None)
+                if chunk is None:
+                    break
+                if chunk and not no_body:
+                    writer.write(chunk)
+                    await writer.drain()
+            await writer.drain()
+        finally:
+            close = getattr(body, 'close', None)
+            if close:
+                await loop.run_in_executor(executor, close)
+        return keep_alive
+
+    def run_wsgi(self, request):
+        """Call the WSGI app, returning (status, headers, body iterator)"""
+        environ = build_environ(request)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = status
+            started['headers'] = list(headers)
+            return write_unsupported
+
+        app_iter = self.app(environ, start_response)
+        body = iter(app_iter)
+        # Flask calls start_response lazily for streamed responses; pull the first chunk
+        first = next(body, None) if 'status' not in started else None
+        if first is not None:
+            body = chain_first(first, body)
+        body = ClosingIterator(body, app_iter)
+        return started['status'], started['headers'], body
+
+
+class ClosingIterator:
+    """Iterator that calls the WSGI app_iter's close() when done"""
+
+    def __init__(self, iterator, app_iter):
+        self.iterator = iterator
+        self.app_iter = app_iter
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close:
+            close()
+
+
+def write_unsupported(data):
+    raise RuntimeError("The WSGI write() callable is not supported")
+
+
+def chain_first(first, rest):
+    yield first
+    yield from rest
+
+
+async def read_request(reader, remote_addr):
+    """Read one request, None when the client closed the connection"""
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise
+    except asyncio.LimitOverrunError:
+        raise BadRequest("Request header too large")
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ', 2)
+    except ValueError:
+        raise BadRequest("Malformed request line")
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise BadRequest("Malformed header")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise BadRequest("Invalid Content-Length")
+    if length < 0:
+        raise BadRequest("Invalid Content-Length")
+    if length > MAX_BODY_SIZE:
+        raise BadRequest("Request body too large")
+    if 'transfer-encoding' in headers:
+        # Unread chunks would be parsed as the next request
+        raise BadRequest("Chunked request bodies are not supported, send Content-Length", 411)
+    body = await reader.readexactly(length) if length else b''
+    return Request(method.upper(), target, version, headers, body, remote_addr)
+
+
+def build_environ(request):
+    """WSGI environ for a parsed request"""
+    host, _, port = request.headers.get('host', 'localhost').partition(':')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote_to_bytes(request.path).decode('latin-1'),
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': host,
+        'SERVER_PORT': port or '80',
+        'SERVER_PROTOCOL': request.version,
+        'REMOTE_ADDR': request.remote_addr,
+        'CONTENT_TYPE': request.headers.get('content-type', ''),
+        'CONTENT_LENGTH': str(len(request.body)) if request.body else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(request.body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        if name in ('content-type', 'content-length'):
+            continue
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return environ
+
+
+def bodyless(method, status):
+    """True for responses that never carry a body (HEAD, 1xx, 204, 304)"""
+    code = status if isinstance(status, int) else int(status.split(' ', 1)[0])
+    return method == 'HEAD' or code < 200 or code in (204, 304)
+
+
+def format_head(status, headers):
+    """Status line and headers; status is an int or a WSGI status string"""
+    if isinstance(status, int):
+        status = f"{status} {HTTPStatus(status).phrase}"
+    lines = [f"HTTP/1.1 {status}"]
+    lines.extend(f"{name}: {value}" for name, value in headers)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
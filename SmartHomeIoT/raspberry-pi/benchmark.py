@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""
+Load test for the SmartHome Pi servers
+
+`streams` opens an increasing number of concurrent MJPEG viewers against the
+camera server and reports, for each step, the frame rate every viewer
+achieved together with the server's CPU use, RSS and thread count (read from
+/proc, so the server must run on the same Linux machine).
+
+`http` runs keep-alive clients against one endpoint and reports requests/sec,
+p50/p99 latency and RSS.
+
+`suite` starts both servers on mock GPIO and the mock camera and runs the
+standard set: /led (GET and POST), /health, /camera/snapshot and concurrent
+streams. Results can be saved and compared with an earlier run, failing
+when something got slower than --tolerance allows.
+
+Usage:
+    # Start a mock-camera server in async mode and measure it
+    python benchmark.py streams --spawn "python camera_server.py --async --mock"
+
+    # Measure an already running server
+    python benchmark.py streams --url http://127.0.0.1:8081 --pid 1234
+    python benchmark.py http --url http://127.0.0.1:8080 --path /led --pid 1234
+
+    # Full suite, checked against the last release
+    python benchmark.py suite --save after.json --baseline before.json
+
+Only the standard library is needed.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+BOUNDARY = b'--frame\r\n'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def read_proc(pid):
+    """(cpu seconds, rss MB, threads) of a process"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime + stime
+    rss = threads = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) / 1024
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    return cpu, rss, threads
+
+
+def wait_for_server(url, timeout=30, process=None):
+    """Poll /health until the server answers, failing if `process` exits first"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process and process.poll() is not None:
+            raise SystemExit(f"Server for {url} exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(f'{url}/health', timeout=2):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f"Server at {url} did not come up")
+
+
+def port_in_use(url):
+    parts = urlsplit(url)
+    try:
+        with socket.create_connection((parts.hostname, parts.port or 80), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def spawn_server(command, url):
+    """Start a server process next to this script and wait until it answers"""
+    # Otherwise an old server answering on the port would be measured instead
+    if port_in_use(url):
+        raise SystemExit(f"{url} is already in use, stop the server running there first")
+    process = subprocess.Popen(shlex.split(command), cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(url, process=process)
+    except SystemExit:
+        stop_server(process)
+        raise
+    return process
+
+
+def stop_server(process):
+    """Stop a spawned server the way Ctrl+C would, so it cleans up"""
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def open_stream(url, path):
+    """Open a GET request, return (reader, writer) past the response headers"""
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n\r\n'.encode())
+    await writer.drain()
+    await reader.readuntil(b'\r\n\r\n')
+    return reader, writer
+
+
+async def stream_viewer(url, path, stop, counts, index):
+    """Read an MJPEG stream until `stop` is set, counting frames"""
+    reader, writer = await open_stream(url, path)
+    tail = b''
+    try:
+        while not stop.is_set():
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            data = tail + chunk
+            counts[index] += data.count(BOUNDARY)
+            tail = data[-(len(BOUNDARY) - 1):]
+    finally:
+        writer.close()
+
+
+async def measure_streams(url, path, viewers, duration, pid):
+    """Run `viewers` streams for `duration` seconds, return one result row"""
+    stop = asyncio.Event()
+    counts = [0] * viewers
+    tasks = [asyncio.create_task(stream_viewer(url, path, stop, counts, i)) for i in range(viewers)]
+
+    # Let every stream connect and settle before measuring
+    await asyncio.sleep(1)
+    start_counts = list(counts)
+    cpu_start, _, _ = read_proc(pid) if pid else (0, 0, 0)
+    started = time.monotonic()
+    await asyncio.sleep(duration)
+    elapsed = time.monotonic() - started
+    cpu_end, rss, threads = read_proc(pid) if pid else (0, 0, 0)
+    fps = [(end - begin) / elapsed for begin, end in zip(start_counts, counts)]
+
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {
+        'viewers': viewers,
+        'fps_mean': sum(fps) / len(fps),
+        'fps_min': min(fps),
+        'cpu': (cpu_end - cpu_start) / elapsed * 100,
+        'rss': rss,
+        'threads': threads
+    }
+
+
+def parse_head(head):
+    """(status, content length or None, connection closes) of a response head"""
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = headers.get('content-length')
+    close = headers.get('connection', '').lower() == 'close' or lines[0].startswith('HTTP/1.0')
+    return status, int(length) if length is not None else None, close
+
+
+async def http_client(url, request, stop, latencies, errors):
+    """Send `request` over a keep-alive connection until `stop` is set"""
+    parts = urlsplit(url)
+    writer = None
+    while not stop.is_set():
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+            started = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status, length, close = parse_head(await reader.readuntil(b'\r\n\r\n'))
+            if length is None:
+                await reader.read()
+                close = True
+            elif length:
+                await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors[0] += 1
+            if close:
+                writer.close()
+                writer = None
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            errors[0] += 1
+            if writer:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.01)
+    if writer:
+        writer.close()
+
+
+def percentile(values, fraction):
+    return values[int(fraction * (len(values) - 1))] if values else 0.0
+
+
+async def measure_http(url, method, path, body, concurrency, duration, pid):
+    """Run `concurrency` clients for `duration` seconds, return one result row"""
+    host = urlsplit(url).netloc
+    head = f'{method} {path} HTTP/1.1\r\nHost: {host}\r\n'
+    if body is not None:
+        head += f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n'
+    request = (head + '\r\n').encode() + (body or b'')
+
+    stop = asyncio.Event()
+    latencies = []
+    errors = [0]
+    tasks = [asyncio.create_task(http_client(url, request, stop, latencies, errors))
+             for _ in range(concurrency)]
+    # Warm up connections and caches, then measure
+    await asyncio.sleep(0.5)
+    latencies.clear()
+    errors[0] = 0
+    started = time.monotonic()
+    await asyncio.sleep(duration)
+    elapsed = time.monotonic() - started
+    measured = sorted(latencies)
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _, rss, _ = read_proc(pid) if pid else (0, 0, 0)
+    return {
+        'target': f'{method} {path}',
+        'concurrency': concurrency,
+        'rps': len(measured) / elapsed,
+        'p50': percentile(measured, 0.5) * 1000,
+        'p99': percentile(measured, 0.99) * 1000,
+        'errors': errors[0],
+        'rss': rss
+    }
+
+
+def print_table(columns, rows):
+    print('  '.join(f'{title:>{width}}' for title, _, width, _ in columns))
+    for row in rows:
+        print('  '.join(f'{row[key]:>{width}{fmt}}' for _, key, width, fmt in columns))
+
+
+def run_streams(args):
+    """Viewer count against per-viewer FPS, CPU and RSS"""
+    process = spawn_server(args.spawn, args.url) if args.spawn else None
+    pid = process.pid if process else args.pid
+    if not pid:
+        print("No --pid or --spawn given, CPU/RSS columns will be empty", file=sys.stderr)
+    try:
+        wait_for_server(args.url)
+        rows = []
+        for viewers in args.viewers:
+            row = asyncio.run(measure_streams(args.url, args.path, viewers, args.duration, pid))
+            rows.append(row)
+            print(f"{viewers} viewers: {row['fps_mean']:.1f} fps, {row['cpu']:.0f}% CPU", file=sys.stderr)
+    finally:
+        if process:
+            stop_server(process)
+
+    print()
+    print_table(STREAM_COLUMNS, rows)
+
+
+HTTP_COLUMNS = [
+    ('endpoint', 'target', 22, ''),
+    ('clients', 'concurrency', 7, 'd'),
+    ('req/s', 'rps', 8, '.0f'),
+    ('p50 ms', 'p50', 7, '.2f'),
+    ('p99 ms', 'p99', 7, '.2f'),
+    ('errors', 'errors', 6, 'd'),
+    ('RSS MB', 'rss', 7, '.1f'),
+]
+
+STREAM_COLUMNS = [
+    ('viewers', 'viewers', 7, 'd'),
+    ('fps/viewer', 'fps_mean', 10, '.1f'),
+    ('min fps', 'fps_min', 7, '.1f'),
+    ('CPU %', 'cpu', 6, '.0f'),
+    ('RSS MB', 'rss', 7, '.1f'),
+    ('threads', 'threads', 7, 'd'),
+]
+
+
+def run_http(args):
+    """Clients against requests/sec, latency and RSS for one endpoint"""
+    process = spawn_server(args.spawn, args.url) if args.spawn else None
+    pid = process.pid if process else args.pid
+    body = args.data.encode() if args.data is not None else None
+    try:
+        wait_for_server(args.url)
+        rows = [asyncio.run(measure_http(args.url, args.method, args.path, body, clients, args.duration, pid))
+                for clients in args.clients]
+    finally:
+        if process:
+            stop_server(process)
+    print()
+    print_table(HTTP_COLUMNS, rows)
+
+
+# (server, method, path, body) measured by the suite
+SUITE_TARGETS = [
+    ('led', 'GET', '/led', None),
+    ('led', 'POST', '/led', b'{"state": "ON"}'),
+    ('led', 'GET', '/health', None),
+    ('camera', 'GET', '/camera/snapshot', None),
+]
+
+
+def compare(rows, baseline, tolerance, key_fields, checks):
+    """Print changes against a baseline, return the rows that regressed"""
+    previous = {tuple(row[k] for k in key_fields): row for row in baseline}
+    regressions = []
+    for row in rows:
+        before = previous.get(tuple(row[k] for k in key_fields))
+        if not before:
+            continue
+        notes = []
+        for field, higher_is_better in checks:
+            if not before[field]:
+                continue
+            change = (row[field] - before[field]) / before[field]
+            worse = -change if higher_is_better else change
+            flag = ' REGRESSION' if worse > tolerance else ''
+            notes.append(f'{field} {change:+.0%}{flag}')
+            if flag:
+                regressions.append(row)
+        print(' '.join(str(row[k]) for k in key_fields) + ': ' + ', '.join(notes))
+    return regressions
+
+
+def run_suite(args):
+    """Standard endpoint and stream measurements on mock hardware"""
+    servers = {}
+    try:
+        servers['led'] = spawn_server(args.led_command, args.led_url)
+        servers['camera'] = spawn_server(args.camera_command, args.camera_url)
+        urls = {'led': args.led_url, 'camera': args.camera_url}
+
+        http_rows = []
+        for server, method, path, body in SUITE_TARGETS:
+            for clients in args.clients:
+                row = asyncio.run(measure_http(urls[server], method, path, body, clients,
+                                               args.duration, servers[server].pid))
+                http_rows.append(row)
+                print(f"{row['target']} x{clients}: {row['rps']:.0f} req/s, p99 {row['p99']:.1f} ms",
+                      file=sys.stderr)
+
+        stream_rows = []
+        for viewers in args.viewers:
+            row = asyncio.run(measure_streams(args.camera_url, '/camera/stream', viewers,
+                                              args.duration, servers['camera'].pid))
+            stream_rows.append(row)
+            print(f"{viewers} viewers: {row['fps_mean']:.1f} fps", file=sys.stderr)
+
+        # CPU/RSS of a server that died mid-run would read as zero
+        for name, process in servers.items():
+            if process.poll() is not None:
+                raise SystemExit(f"The {name} server exited with code {process.returncode} during the run")
+    finally:
+        for process in servers.values():
+            stop_server(process)
+
+    print()
+    print_table(HTTP_COLUMNS, http_rows)
+    print()
+    print_table(STREAM_COLUMNS, stream_rows)
+
+    results = {'http': http_rows, 'streams': stream_rows}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.baseline} (tolerance {args.tolerance:.0%}):")
+        regressions = compare(http_rows, baseline['http'], args.tolerance, ('target', 'concurrency'),
+                              [('rps', True), ('p99', False), ('rss', False)])
+        regressions += compare(stream_rows, baseline['streams'], args.tolerance, ('viewers',),
+                               [('fps_min', True), ('cpu', False), ('rss', False)])
+        if regressions:
+            raise SystemExit(f"{len(regressions)} regression(s)")
+
+
+def parse_counts(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SmartHome Pi server load test')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    streams = commands.add_parser('streams', help='concurrent MJPEG viewers against the camera server')
+    streams.add_argument('--url', default='http://127.0.0.1:8081')
+    streams.add_argument('--path', default='/camera/stream', help='stream path, may include query args')
+    streams.add_argument('--viewers', type=parse_counts, default=[1, 5, 10, 25, 50],
+                         help='comma separated viewer counts (default 1,5,10,25,50)')
+    streams.add_argument('--duration', type=float, default=10, help='seconds measured per step')
+    streams.add_argument('--pid', type=int, help='server process to sample CPU/RSS from')
+    streams.add_argument('--spawn', help='command that starts the server (run from this folder)')
+    streams.set_defaults(func=run_streams)
+
+    http = commands.add_parser('http', help='keep-alive clients against one endpoint')
+    http.add_argument('--url', default='http://127.0.0.1:8080')
+    http.add_argument('--path', default='/led')
+    http.add_argument('--method', default='GET')
+    http.add_argument('--data', help='JSON request body')
+    http.add_argument('--clients', type=parse_counts, default=[1, 16],
+                      help='comma separated client counts (default 1,16)')
+    http.add_argument('--duration', type=float, default=10, help='seconds measured per step')
+    http.add_argument('--pid', type=int, help='server process to sample RSS from')
+    http.add_argument('--spawn', help='command that starts the server (run from this folder)')
+    http.set_defaults(func=run_http)
+
+    suite = commands.add_parser('suite', help='standard benchmark of both servers on mock hardware')
+    suite.add_argument('--led-command', default='python3 led_server.py --async --mock --no-journal')
+    suite.add_argument('--camera-command', default='python3 camera_server.py --async --mock')
+    suite.add_argument('--led-url', default='http://127.0.0.1:8080')
+    suite.add_argument('--camera-url', default='http://127.0.0.1:8081')
+    suite.add_argument('--clients', type=parse_counts, default=[1, 16],
+                       help='comma separated client counts per endpoint (default 1,16)')
+    suite.add_argument('--viewers', type=parse_counts, default=[1, 10, 25],
+                       help='comma separated stream viewer counts (default 1,10,25)')
+    suite.add_argument('--duration', type=float, default=5, help='seconds measured per step')
+    suite.add_argument('--save', help='write results to this JSON file')
+    suite.add_argument('--baseline', help='compare with results saved by an earlier run')
+    suite.add_argument('--tolerance', type=float, default=0.2,
+                       help='allowed slowdown before a result counts as a regression (default 0.2)')
+    suite.set_defaults(func=run_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,21 +7,42 @@ Endpoints:
 - GET  /               : Camera web interface
 - GET  /camera/stream  : MJPEG video stream
 - GET  /camera/snapshot: Single JPEG frame
-- POST /camera/start   : Start camera
-- POST /camera/stop    : Stop camera
+- POST /camera/start   : Keep the camera running
+- POST /camera/stop    : Release the /camera/start hold
 - GET  /camera/status  : Camera status
+- GET  /camera/metrics : Pipeline metrics (Prometheus text format)
+- GET  /camera/motion  : Motion detector state and recent events
+- GET  /camera/motion/events?since=<version>: Long-poll for motion events
+- GET  /camera/recording: Rolling recorder status
+- POST /camera/record/event: Mark an event, returns its clip window
+- GET  /camera/clip?start=<ts>&end=<ts>: Recorded clip (concatenated JPEGs)
+- GET  /camera/exports/<name>: Event clip copied out of the recording ring
 
 Hardware:
 - Raspberry Pi Camera Module v2 or compatible
 - Or USB webcam
 """
 
-from flask import Flask, Response, jsonify
+from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
+from email.utils import formatdate, parsedate_to_datetime
+import argparse
+import signal
+import asyncio
 import time
 import logging
 import io
+import os
+import mmap
+import math
+import bisect
+import struct
 import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from async_server import AsyncServer, AsyncResponse, Signal
+from admission import AdmissionControl, install_flask
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -35,6 +56,12 @@ try:
     from picamera2 import Picamera2
     CAMERA_TYPE = 'picamera2'
     logger.info("Using Picamera2 (Raspberry Pi Camera)")
+    try:
+        from picamera2.encoders import MJPEGEncoder
+        from picamera2.outputs import FileOutput
+    except ImportError:
+        MJPEGEncoder = None
+        logger.warning("Picamera2 encoders not available, using still capture")
 except ImportError:
     try:
         import cv2
@@ -43,111 +70,1115 @@ except ImportError:
     except ImportError:
         logger.warning("No camera library available, running in mock mode")
 
+# Pillow is used to re-encode per-client stream variants
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+    logger.warning("Pillow not available, stream variants disabled")
+
+# NumPy is used by the motion detector
+try:
+    import numpy as np
+except ImportError:
+    np = None
+    logger.warning("NumPy not available, motion detection disabled")
+
 app = Flask(__name__)
 CORS(app)
 
+# Capture configuration
+CAMERA_RESOLUTION = (640, 480)
+CAMERA_FPS = 30
+# Picamera2 mode: 'video' streams through the hardware MJPEG encoder,
+# 'still' captures and software-encodes a still image per frame
+PICAMERA_MODE = 'video'
+# OpenCV path: JPEG encodes run on this many worker threads while the capture
+# thread keeps reading (cv2.imencode releases the GIL, so they use all cores)
+ENCODE_WORKERS = 3
+# The camera starts with its first consumer (stream, snapshot, recorder) and
+# stops this many seconds after the last one leaves
+CAMERA_IDLE_TIMEOUT = 30
+# Snapshots reuse the latest frame while it is younger than this (seconds)
+SNAPSHOT_MAX_AGE = 1.0
+SNAPSHOT_WAIT = 3.0  # Longest wait for a first frame after the camera starts
+# Per-client variants (?width=&height=&quality=): each is encoded once per frame
+MAX_VARIANTS = 8
+DEFAULT_VARIANT_QUALITY = 75
+
+# Duplicate frame suppression: a frame that looks like the last one sent is
+# dropped before it reaches viewers; on a static scene one keep-alive frame
+# still goes out every KEEPALIVE_INTERVAL seconds
+SKIP_DUPLICATE_FRAMES = True
+FINGERPRINT_SIZE = (32, 24)
+DUPLICATE_THRESHOLD = 6         # Brightness change (0-255) of any fingerprint cell that counts as new
+KEEPALIVE_INTERVAL = 1.0
+
+# Motion detection (frame differencing on a small grayscale copy)
+MOTION_ENABLED = True
+MOTION_SIZE = (160, 120)
+MOTION_PIXEL_THRESHOLD = 25     # Brightness change (0-255) for a pixel to count
+MOTION_AREA_THRESHOLD = 0.01    # Fraction of watched pixels that must change
+MOTION_COOLDOWN = 2.0           # Seconds without motion before an event ends
+# Regions of interest as (x0, y0, x1, y1) fractions of the frame, empty = whole frame
+MOTION_ROIS = []
+MOTION_EVENT_HISTORY = 50
+# Mock camera (no camera library found, or --mock)
+MOCK_PATTERN = 'moving'         # 'moving' (a marker changes every frame) or 'static'
+# Draw a large moving box every few seconds so the motion detector has something to see
+MOCK_MOTION = False
+MOCK_SOURCE = None              # Directory of JPEGs or a video file to replay instead
+MOCK_REALTIME = True            # False replays as fast as possible
+MOCK_REPLAY_MAX_FRAMES = 1800
+MOCK_FALLBACK_JPEG = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00\xff\xdb\x00C\x00\x08\x06\x06\x07\x06\x05\x08\x07\x07\x07\t\t\x08\n\x0c\x14\r\x0c\x0b\x0b\x0c\x19\x12\x13\x0f\x14\x1d\x1a\x1f\x1e\x1d\x1a\x1c\x1c $.\' ",#\x1c\x1c(7),01444\x1f\'9telecom/telecom//444444444444\xff\xc0\x00\x0b\x08\x00\x01\x00\x01\x01\x01\x11\x00\xff\xc4\x00\x1f\x00\x00\x01\x05\x01\x01\x01\x01\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00\x01\x02\x03\x04\x05\x06\x07\x08\t\n\x0b\xff\xc4\x00\xb5\x10\x00\x02\x01\x03\x03\x02\x04\x03\x05\x05\x04\x04\x00\x00\x01}\x01\x02\x03\x00\x04\x11\x05\x12!1A\x06\x13Qa\x07"q\x142\x81\x91\xa1\x08#B\xb1\xc1\x15R\xd1\xf0$3br\x82\t\n\x16\x17\x18\x19\x1a%&\'()*456789:CDEFGHIJSTUVWXYZcdefghijstuvwxyz\x83\x84\x85\x86\x87\x88\x89\x8a\x92\x93\x94\x95\x96\x97\x98\x99\x9a\xa2\xa3\xa4\xa5\xa6\xa7\xa8\xa9\xaa\xb2\xb3\xb4\xb5\xb6\xb7\xb8\xb9\xba\xc2\xc3\xc4\xc5\xc6\xc7\xc8\xc9\xca\xd2\xd3\xd4\xd5\xd6\xd7\xd8\xd9\xda\xe1\xe2\xe3\xe4\xe5\xe6\xe7\xe8\xe9\xea\xf1\xf2\xf3\xf4\xf5\xf6\xf7\xf8\xf9\xfa\xff\xda\x00\x08\x01\x01\x00\x00?\x00\xfb\xd7\xff\xd9'  # 1x1 pixel, used without Pillow
+
+# Rolling recorder: frames are appended to a fixed ring of preallocated,
+# memory-mapped segment files, so disk use and memory stay constant
+RECORDING_ENABLED = False
+RECORDING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings')
+RECORDING_SEGMENTS = 8
+RECORDING_SEGMENT_SIZE = 32 * 1024 * 1024  # bytes
+RECORDING_SECONDS = 300         # History kept at most (split across the segments)
+RECORDING_PRE_SECONDS = 10      # Clip length before an event
+RECORDING_POST_SECONDS = 10     # Clip length after an event
+RECORDING_MAX_CLIP = 300        # Longest clip served (seconds)
+RECORDING_INDEX_FLUSH = 1.0     # Seconds between index flushes (frames a crash can lose)
+# Event clips are copied here once recorded, so they outlive the ring
+RECORDING_EXPORT_DIR = os.path.join(RECORDING_DIR, 'events')
+RECORDING_EXPORTS = 20          # Exported clips kept, the oldest are deleted
+
+# Latency histogram buckets (seconds) for /camera/metrics
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+VIEWER_FPS_WINDOW = 5.0  # Seconds over which a viewer's achieved FPS is measured
+
+# Admission control: (method, path, requests/s, burst) per client and endpoint, first match wins
+RATE_LIMITS = [
+    ('GET', '/camera/stream', 1, 5),
+    ('GET', '/camera/snapshot', 10, 20),
+    ('GET', '/camera/clip', 1, 3),
+    ('GET', '/camera/exports/*', 1, 3),
+    ('POST', '/camera/*', 2, 5),
+    ('GET', '/*', 20, 40),
+]
+PRIORITY_PATHS = ['/health', '/camera/status', '/camera/metrics']  # Skip the caps below
+STREAM_PATHS = ['/camera/stream', '/camera/motion/events', '/camera/clip', '/camera/exports/*']
+MAX_STREAMS = 25  # Open streams, long-polls and clip downloads
+MAX_ACTIVE_REQUESTS = 16  # Other requests in progress before new ones get a 503
+
 # Camera state
 camera_active = False
 frame_count = 0
 last_frame = None
+last_frame_time = None
+last_seen_time = None  # Last capture confirming last_frame is still current
+frames_skipped = 0
+published_fingerprint = None
 lock = threading.Lock()
 
+# Shared frame buffer: one capture thread produces, every viewer waits on
+# frame_ready and picks up last_frame. frame_count is the generation counter.
+frame_ready = threading.Condition(lock)
+publish_times = deque(maxlen=256)  # Monotonic publish time of the newest generations
+capture_thread = None
+encoder = None  # Picamera2 hardware encoder when running in video mode
+
+# Pipelined OpenCV encoding: captures are numbered and only published if
+# newer than the last published one, so viewers always see frames in order
+encode_pool = None
+encode_slots = threading.BoundedSemaphore(ENCODE_WORKERS)
+encode_order_lock = threading.Lock()
+encode_seq = 0
+published_seq = 0
+
+# Consumer reference counting, guarded by camera_lock
+camera_lock = threading.RLock()
+camera_users = 0
+camera_held = False  # Reference taken by POST /camera/start
+idle_timer = None
+# Makes snapshot ETags unique across restarts (frame_count starts over)
+ETAG_PREFIX = f"{int(time.time()):x}"
+# Wakes asyncio viewers (--async mode) on every new frame
+frame_signal = Signal()
+# (width, height, quality) -> [lock, generation, frame], least recently used first
+variant_cache = OrderedDict()
+variant_cache_lock = threading.Lock()
+
+# Motion detector state, guarded by motion_changed
+motion_thread = None
+motion_changed = threading.Condition()
+motion_state = {
+    'active': False,
+    'score': 0.0,
+    'last_motion': None,
+    'frames_analyzed': 0
+}
+motion_events = deque(maxlen=MOTION_EVENT_HISTORY)
+motion_version = 0  # Bumped whenever an event starts or ends
+motion_signal = Signal()
+
+# Metrics state, guarded by metrics_lock
+metrics_lock = threading.Lock()
+viewers = {}  # id -> per-viewer counters
+next_viewer_id = 0
+closed_viewer_drops = 0
+encode_queue_depth = 0  # Variant encodes running or waiting for their turn
+frames_dropped_encoder = 0  # Captures dropped because every encode worker was busy
+encodes_in_flight = 0
+
+# Recorder state, guarded by recorder_lock
+recorder_thread = None
+recorder_lock = threading.Lock()
+segments = []
+current_segment = None
+
+class Histogram:
+    """Cumulative histogram rendered in the Prometheus text format"""
+    
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+    
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if index < len(self.counts):
+                self.counts[index] += 1
+            self.total += value
+            self.count += 1
+    
+    def render(self, name, labels):
+        with self.lock:
+            counts, total, count = list(self.counts), self.total, self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f'{name}_sum{{{labels}}} {total:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {count}')
+        return lines
+
+# Per-stage timings: capture, encode (camera frame), variant_encode (per-client
+# re-encode), queue (publish until a viewer picks it up), write (socket send)
+stage_timings = {stage: Histogram() for stage in ('capture', 'encode', 'variant_encode', 'queue', 'write')}
+
+def acquire_camera():
+    """Register a consumer, starting the camera for the first one"""
+    global camera_users
+    
+    with camera_lock:
+        camera_users += 1
+        cancel_idle_timer()
+        if not camera_active:
+            init_camera()
+        return camera_active
+
+def release_camera():
+    """Unregister a consumer; the last one schedules the idle stop"""
+    global camera_users, idle_timer
+    
+    with camera_lock:
+        camera_users = max(camera_users - 1, 0)
+        if camera_users == 0 and camera_active and not idle_timer:
+            idle_timer = threading.Timer(CAMERA_IDLE_TIMEOUT, stop_idle_camera)
+            idle_timer.daemon = True
+            idle_timer.start()
+
+def cancel_idle_timer():
+    global idle_timer
+    
+    with camera_lock:
+        if idle_timer:
+            idle_timer.cancel()
+            idle_timer = None
+
+def stop_idle_camera():
+    """Stop the camera if nobody came back during the grace period"""
+    global idle_timer
+    
+    with camera_lock:
+        if idle_timer is not threading.current_thread():
+            return  # Cancelled or replaced by a newer timer
+        idle_timer = None
+        if camera_users == 0 and camera_active:
+            logger.info("No camera consumers left, stopping camera")
+            stop_camera()
+
 def init_camera():
     """Initialize camera"""
     global camera, camera_active
     
     if CAMERA_TYPE == 'picamera2':
-        camera = Picamera2()
-        config = camera.create_still_configuration(main={"size": (640, 480)})
-        camera.configure(config)
-        camera.start()
+        # The configured Picamera2 object is kept between starts, so a
+        # restart is only a start() call
+        if camera is None:
+            configure_picamera()
+        start_picamera()
         camera_active = True
-        logger.info("Picamera2 initialized")
+        logger.info(f"Picamera2 started ({'hardware MJPEG' if encoder else 'still capture'})")
         
     elif CAMERA_TYPE == 'opencv':
         camera = cv2.VideoCapture(0)
-        camera.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+        camera.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_RESOLUTION[0])
+        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_RESOLUTION[1])
         if camera.isOpened():
             camera_active = True
             logger.info("OpenCV camera initialized")
         else:
             logger.error("Failed to open camera")
     else:
+        if camera is None:
+            camera = MockCamera(MOCK_SOURCE)
         camera_active = True  # Mock mode
         logger.info("Running in mock mode (no camera)")
+    
+    # The hardware encoder pushes frames itself, other modes need a capture thread
+    if camera_active and not encoder:
+        start_capture_thread()
+    if camera_active:
+        start_motion_thread()
+        start_recorder_thread()
 
-def get_frame():
-    """Capture a single frame"""
-    global frame_count, last_frame
+class EncoderOutput(io.BufferedIOBase):
+    """File-like sink for the hardware encoder, publishes every JPEG it writes
+    
+    The capture stage is the wait between frames from the encoder, which is
+    what a blocking camera read measures in the other modes.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.last_write = None
+    
+    def writable(self):
+        return True
+    
+    def write(self, buf):
+        now = time.monotonic()
+        if self.last_write is not None:
+            stage_timings['capture'].observe(now - self.last_write)
+        self.last_write = now
+        fingerprint = jpeg_fingerprint(buf)
+        if not is_duplicate(fingerprint):
+            publish_frame(buf, fingerprint)
+        return len(buf)
+
+def configure_picamera():
+    """Create and configure Picamera2 (video mode with the hardware encoder if possible)"""
+    global camera, encoder
+    
+    camera = Picamera2()
+    if PICAMERA_MODE == 'video' and MJPEGEncoder:
+        try:
+            config = camera.create_video_configuration(
+                main={"size": CAMERA_RESOLUTION},
+                controls={"FrameRate": CAMERA_FPS}
+            )
+            camera.configure(config)
+            encoder = MJPEGEncoder()
+            return
+        except Exception as e:
+            logger.warning(f"Video configuration failed ({e}), falling back to still capture")
+            encoder = None
+    config = camera.create_still_configuration(main={"size": CAMERA_RESOLUTION})
+    camera.configure(config)
+
+def start_picamera():
+    """Start the configured Picamera2, streaming through the hardware encoder if set up"""
+    global encoder
+    
+    if encoder:
+        try:
+            camera.start_recording(encoder, FileOutput(EncoderOutput()))
+            return
+        except Exception as e:
+            logger.warning(f"Hardware MJPEG encoder failed ({e}), falling back to still capture")
+            encoder = None
+            try:
+                camera.stop()
+            except Exception:
+                pass
+            camera.configure(camera.create_still_configuration(main={"size": CAMERA_RESOLUTION}))
+    camera.start()
+
+def start_capture_thread():
+    """Start the background capture thread (only one at a time)"""
+    global capture_thread
     
+    if capture_thread and capture_thread.is_alive():
+        return
+    capture_thread = threading.Thread(target=capture_loop, name='camera-capture', daemon=True)
+    capture_thread.start()
+
+def capture_loop():
+    """Capture each frame once and broadcast it to all viewers
+    
+    Captures follow a fixed schedule rather than sleeping a fixed time after
+    each one, so capture time and sleep jitter do not add up to drift.
+    """
+    interval = 1.0 / CAMERA_FPS
+    paced = CAMERA_TYPE is not None or MOCK_REALTIME
+    next_capture = time.monotonic()
+    while camera_active and capture_thread is threading.current_thread():
+        try:
+            get_frame()
+        except Exception as e:
+            logger.error(f"Frame capture failed: {e}")
+        if not paced:
+            continue
+        next_capture += interval
+        delay = next_capture - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -interval:
+            # Fell more than a frame behind: skip ahead instead of bursting
+            next_capture = time.monotonic()
+    
+    # Wake up viewers so they notice the camera has stopped
+    with frame_ready:
+        frame_ready.notify_all()
+
+def get_frame():
+    """Capture a single frame (None if it duplicates the last one)"""
+    started = time.monotonic()
     if CAMERA_TYPE == 'picamera2':
         stream = io.BytesIO()
         camera.capture_file(stream, format='jpeg')
         frame = stream.getvalue()
+        stage_timings['capture'].observe(time.monotonic() - started)
+        fingerprint = jpeg_fingerprint(frame)
         
     elif CAMERA_TYPE == 'opencv':
         ret, img = camera.read()
-        if ret:
-            _, frame = cv2.imencode('.jpg', img)
-            frame = frame.tobytes()
-        else:
-            frame = None
+        stage_timings['capture'].observe(time.monotonic() - started)
+        frame = None
+        fingerprint = None
+        if not ret:
+            return None
+        fingerprint = array_fingerprint(img)
+        # Unchanged scene: skip the encode as well
+        if is_duplicate(fingerprint):
+            return None
+        if ENCODE_WORKERS > 1:
+            # Published by an encode worker, capture continues right away
+            submit_encode(img, fingerprint)
+            return None
+        frame = encode_frame(img)
+        publish_frame(frame, fingerprint)
+        return frame
             
     else:
-        # Mock: generate placeholder image
-        frame = generate_mock_frame()
-    
-    if frame:
-        with lock:
-            frame_count += 1
-            last_frame = frame
+        # Mock: pre-encoded frames with pre-computed fingerprints
+        frame, fingerprint = camera.read()
+        stage_timings['capture'].observe(time.monotonic() - started)
     
+    if not frame or is_duplicate(fingerprint):
+        return None
+    publish_frame(frame, fingerprint)
     return frame
 
-def generate_mock_frame():
-    """Generate a mock JPEG frame for testing"""
-    # Create a simple colored rectangle as mock frame
+def encode_frame(img):
+    """JPEG-encode a raw OpenCV frame"""
+    started = time.monotonic()
+    _, frame = cv2.imencode('.jpg', img)
+    stage_timings['encode'].observe(time.monotonic() - started)
+    return frame.tobytes()
+
+def submit_encode(img, fingerprint):
+    """Hand a captured frame to the encode pool, dropping it if all workers are busy"""
+    global encode_pool, encode_seq, frames_dropped_encoder, encodes_in_flight
+    
+    if not encode_slots.acquire(blocking=False):
+        # Queueing would only add latency: the next capture is fresher anyway
+        with metrics_lock:
+            frames_dropped_encoder += 1
+        return
+    with metrics_lock:
+        encodes_in_flight += 1
+    if encode_pool is None:
+        encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix='camera-encode')
+    encode_seq += 1
+    encode_pool.submit(encode_and_publish, encode_seq, img, fingerprint)
+
+def encode_and_publish(seq, img, fingerprint):
+    """Encode worker: publish the frame unless a later capture beat it"""
+    global published_seq, frames_dropped_encoder, encodes_in_flight
+    
+    try:
+        frame = encode_frame(img)
+        with encode_order_lock:
+            if seq > published_seq:
+                published_seq = seq
+                publish_frame(frame, fingerprint)
+                return
+        with metrics_lock:
+            frames_dropped_encoder += 1
+    except Exception as e:
+        logger.error(f"Frame encode failed: {e}")
+    finally:
+        with metrics_lock:
+            encodes_in_flight -= 1
+        encode_slots.release()
+
+def publish_frame(frame, fingerprint=None):
+    """Store a new frame in the shared buffer and wake up viewers"""
+    global frame_count, last_frame, last_frame_time, last_seen_time, published_fingerprint
+    
+    with frame_ready:
+        frame_count += 1
+        publish_times.append(time.monotonic())
+        last_frame = frame
+        last_frame_time = last_seen_time = time.time()
+        published_fingerprint = fingerprint
+        frame_ready.notify_all()
+    frame_signal.notify()
+
+def jpeg_fingerprint(frame):
+    """Tiny grayscale thumbnail of a JPEG for change detection (None if disabled)"""
+    if not (SKIP_DUPLICATE_FRAMES and np is not None and Image):
+        return None
+    try:
+        img = Image.open(io.BytesIO(frame))
+        img.draft('L', FINGERPRINT_SIZE)  # Decode at 1/8 scale
+        img = img.convert('L').resize(FINGERPRINT_SIZE, Image.BILINEAR)
+        return np.asarray(img, dtype=np.int16)
+    except Exception:
+        return None
+
+def array_fingerprint(img):
+    """Tiny grayscale thumbnail of a raw OpenCV frame (None if disabled)"""
+    if not (SKIP_DUPLICATE_FRAMES and np is not None):
+        return None
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, FINGERPRINT_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+def is_duplicate(fingerprint):
+    """True if a frame matches the last published one and no keep-alive is due"""
+    global last_seen_time, frames_skipped
+    
+    if fingerprint is None:
+        return False
+    with frame_ready:
+        now = time.time()
+        if published_fingerprint is None or now - last_frame_time >= KEEPALIVE_INTERVAL:
+            return False
+        if np.abs(fingerprint - published_fingerprint).max() > DUPLICATE_THRESHOLD:
+            return False
+        # The cached frame is still an accurate picture of the scene
+        last_seen_time = now
+        frames_skipped += 1
+        return True
+
+def wait_for_frame(seen, timeout=1.0):
+    """Wait for a frame newer than generation `seen`, return (generation, frame, published_at)"""
+    with frame_ready:
+        frame_ready.wait_for(lambda: frame_count != seen or not camera_active, timeout)
+        return frame_count, last_frame, last_frame_time
+
+def generation_at(when):
+    """Newest generation published by monotonic time `when`"""
+    with frame_ready:
+        return frame_count - len(publish_times) + bisect.bisect_right(publish_times, when)
+
+def parse_variant(args):
+    """Read width/height/quality query args into a variant key (None = source frame)"""
+    width = args.get('width', type=int)
+    height = args.get('height', type=int)
+    quality = args.get('quality', type=int)
+    if not Image or not (width or height or quality):
+        return None
+    
+    src_width, src_height = CAMERA_RESOLUTION
+    if width and not height:
+        height = width * src_height // src_width
+    elif height and not width:
+        width = height * src_width // src_height
+    width = min(max(width or src_width, 16), src_width)
+    height = min(max(height or src_height, 16), src_height)
+    quality = min(max(quality or DEFAULT_VARIANT_QUALITY, 10), 95)
+    return (width, height, quality)
+
+def get_variant(key, generation, frame):
+    """Encode a frame for a variant once per generation, shared by its viewers"""
+    global encode_queue_depth
+    
+    if key is None:
+        return frame
+    
+    with variant_cache_lock:
+        entry = variant_cache.get(key)
+        if entry is None:
+            if len(variant_cache) >= MAX_VARIANTS:
+                variant_cache.popitem(last=False)
+            entry = variant_cache[key] = [threading.Lock(), None, None]
+        variant_cache.move_to_end(key)
+    
+    with metrics_lock:
+        encode_queue_depth += 1
     try:
-        from PIL import Image, ImageDraw, ImageFont
+        with entry[0]:
+            # A viewer that got here first (or with a newer frame) already encoded it
+            if entry[1] is None or entry[1] < generation:
+                started = time.monotonic()
+                entry[2] = encode_variant(frame, key)
+                entry[1] = generation
+                stage_timings['variant_encode'].observe(time.monotonic() - started)
+            return entry[2]
+    finally:
+        with metrics_lock:
+            encode_queue_depth -= 1
+
+def encode_variant(frame, key):
+    """Resize and re-encode a JPEG frame"""
+    width, height, quality = key
+    img = Image.open(io.BytesIO(frame))
+    img.draft('RGB', (width, height))  # Let the JPEG decoder downscale for free
+    if img.size != (width, height):
+        img = img.resize((width, height), Image.BILINEAR)
+    buffer = io.BytesIO()
+    img.convert('RGB').save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+def start_motion_thread():
+    """Start the motion detector on the shared frames"""
+    global motion_thread
+    
+    if not (MOTION_ENABLED and np is not None and Image):
+        return
+    if motion_thread and motion_thread.is_alive():
+        return
+    motion_thread = threading.Thread(target=motion_loop, name='camera-motion', daemon=True)
+    motion_thread.start()
+
+def build_motion_mask():
+    """Boolean mask of the watched pixels, None for the whole frame"""
+    if not MOTION_ROIS:
+        return None
+    width, height = MOTION_SIZE
+    mask = np.zeros((height, width), dtype=bool)
+    for x0, y0, x1, y1 in MOTION_ROIS:
+        mask[int(y0 * height):int(y1 * height), int(x0 * width):int(x1 * width)] = True
+    return mask
+
+def decode_motion_frame(frame):
+    """Decode a JPEG into the small grayscale array used for differencing"""
+    img = Image.open(io.BytesIO(frame))
+    img.draft('L', MOTION_SIZE)  # Downscale inside the JPEG decoder
+    img = img.convert('L')
+    if img.size != MOTION_SIZE:
+        img = img.resize(MOTION_SIZE, Image.NEAREST)
+    return np.asarray(img, dtype=np.int16)
+
+def motion_loop():
+    """Score motion between consecutive frames
+    
+    Works on whatever frame is newest, so a slow detector skips frames
+    instead of holding up capture or viewers.
+    """
+    mask = build_motion_mask()
+    watched = mask.sum() if mask is not None else MOTION_SIZE[0] * MOTION_SIZE[1]
+    previous = None
+    seen = None
+    while camera_active and motion_thread is threading.current_thread():
+        generation, frame, _ = wait_for_frame(seen)
+        if not frame or generation == seen:
+            continue
+        seen = generation
+        try:
+            gray = decode_motion_frame(frame)
+        except Exception as e:
+            logger.error(f"Motion decode failed: {e}")
+            continue
+        if previous is not None and watched:
+            changed = np.abs(gray - previous) > MOTION_PIXEL_THRESHOLD
+            if mask is not None:
+                changed &= mask
+            update_motion(float(changed.sum()) / watched)
+        previous = gray
+
+def update_motion(score):
+    """Record a motion score, opening or closing events as needed"""
+    global motion_version
+    
+    now = time.time()
+    with motion_changed:
+        motion_state['score'] = round(score, 4)
+        motion_state['frames_analyzed'] += 1
+        if score >= MOTION_AREA_THRESHOLD:
+            motion_state['last_motion'] = now
+            if not motion_state['active']:
+                motion_state['active'] = True
+                motion_version += 1
+                motion_events.append({
+                    'id': motion_version,
+                    'version': motion_version,
+                    'start': now,
+                    'end': None,
+                    'peak_score': round(score, 4)
+                })
+                motion_changed.notify_all()
+                motion_signal.notify()
+            else:
+                event = motion_events[-1]
+                event['peak_score'] = max(event['peak_score'], round(score, 4))
+        elif motion_state['active'] and now - motion_state['last_motion'] >= MOTION_COOLDOWN:
+            motion_state['active'] = False
+            motion_version += 1
+            event = motion_events[-1]
+            event['end'] = motion_state['last_motion']
+            event['version'] = motion_version
+            if recorder_thread:
+                start = event['start'] - RECORDING_PRE_SECONDS
+                end = event['end'] + RECORDING_POST_SECONDS
+                event['clip'] = clip_url(start, end)
+                event['export'] = schedule_export(start, end)
+            motion_changed.notify_all()
+            motion_signal.notify()
+
+# Index entry per frame: timestamp, offset, length
+INDEX_HEADER = struct.Struct('<Q')
+INDEX_ENTRY = struct.Struct('<dII')
+
+class Segment:
+    """Preallocated memory-mapped recording file with a timestamp index
+    
+    Frames are only ever appended; when the ring wraps around the segment
+    is reset and overwritten from the start.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path[:-len('.mjpeg')] + '.idx'
+        self.seq = 0
+        self.used = 0
+        self.index = []  # (timestamp, offset, length)
+        self.closed = False
+        with open(path, 'a+b') as f:
+            f.truncate(RECORDING_SEGMENT_SIZE)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), RECORDING_SEGMENT_SIZE)
+        self.index_file = None
+        self.load_index()
+    
+    def load_index(self):
+        """Pick up frames recorded before a restart"""
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if len(data) < INDEX_HEADER.size:
+            return
+        self.seq = INDEX_HEADER.unpack_from(data)[0]
+        usable = (len(data) - INDEX_HEADER.size) // INDEX_ENTRY.size * INDEX_ENTRY.size
+        self.index = list(INDEX_ENTRY.iter_unpack(data[INDEX_HEADER.size:INDEX_HEADER.size + usable]))
+        if self.index:
+            _, offset, length = self.index[-1]
+            self.used = offset + length
+    
+    def reset(self, seq):
+        """Start overwriting this segment as the newest one in the ring"""
+        self.close_index()
+        self.seq = seq
+        self.used = 0
+        self.index = []
+        self.index_file = open(self.index_path, 'wb')
+        self.index_file.write(INDEX_HEADER.pack(seq))
+    
+    def append(self, timestamp, frame):
+        """Append a frame, False if it does not fit"""
+        length = len(frame)
+        if self.used + length > RECORDING_SEGMENT_SIZE:
+            return False
+        offset = self.used
+        self.map[offset:offset + length] = frame
+        self.used += length
+        self.index.append((timestamp, offset, length))
+        self.index_file.write(INDEX_ENTRY.pack(timestamp, offset, length))
+        return True
+    
+    def read(self, offset, length):
+        """Copy a single frame out of the mapping"""
+        return self.map[offset:offset + length]
+    
+    def flush_index(self):
+        """Hand buffered index entries to the OS, so they survive a crash"""
+        if self.index_file:
+            self.index_file.flush()
+    
+    def close_index(self):
+        if self.index_file:
+            self.index_file.close()
+            self.index_file = None
+    
+    def close(self):
+        self.closed = True
+        self.close_index()
+        self.map.close()
+        self.file.close()
+
+def start_recorder_thread():
+    """Open the segment ring and start recording the shared frames"""
+    global recorder_thread, segments, current_segment
+    
+    if not RECORDING_ENABLED:
+        return
+    if recorder_thread and recorder_thread.is_alive():
+        return
+    
+    os.makedirs(RECORDING_DIR, exist_ok=True)
+    with recorder_lock:
+        if not segments:
+            segments = [Segment(os.path.join(RECORDING_DIR, f'segment-{i:02d}.mjpeg'))
+                        for i in range(RECORDING_SEGMENTS)]
+        # Always continue in a fresh segment, after whatever survived a restart
+        current_segment = None
+    recorder_thread = threading.Thread(target=recorder_loop, name='camera-recorder', daemon=True)
+    recorder_thread.start()
+    logger.info(f"Recorder writing to {RECORDING_DIR}")
+
+def next_segment():
+    """Recycle the oldest segment as the one to write to"""
+    global current_segment
+    
+    if current_segment:
+        current_segment.close_index()
+    newest = max(segment.seq for segment in segments)
+    oldest = min(segments, key=lambda segment: segment.seq)
+    oldest.reset(newest + 1)
+    current_segment = oldest
+    return oldest
+
+def recorder_loop():
+    """Append every new frame to the segment ring"""
+    segment_span = RECORDING_SECONDS / RECORDING_SEGMENTS
+    seen = None
+    flushed = time.monotonic()
+    while camera_active and recorder_thread is threading.current_thread():
+        generation, frame, _ = wait_for_frame(seen)
+        if frame and generation != seen:
+            seen = generation
+            now = time.time()
+            with recorder_lock:
+                segment = current_segment or next_segment()
+                if segment.index and now - segment.index[0][0] >= segment_span:
+                    segment = next_segment()
+                if not segment.append(now, frame):
+                    segment = next_segment()
+                    if not segment.append(now, frame):
+                        logger.warning("Frame larger than a recording segment, skipped")
         
-        img = Image.new('RGB', (640, 480), color=(50, 50, 50))
+        # wait_for_frame() times out every second, so this runs even without new frames
+        if time.monotonic() - flushed >= RECORDING_INDEX_FLUSH:
+            flushed = time.monotonic()
+            with recorder_lock:
+                if current_segment:
+                    current_segment.flush_index()
+    
+    with recorder_lock:
+        # A replaced recorder must not close its successor's segment
+        if current_segment and recorder_thread is threading.current_thread():
+            current_segment.close_index()
+
+def stop_recorder():
+    """Release the segment mappings"""
+    global segments, current_segment, recorder_thread
+    
+    with recorder_lock:
+        for segment in segments:
+            segment.close()
+        segments = []
+        current_segment = None
+    recorder_thread = None
+
+def recorded_frames(start, end):
+    """Index entries in [start, end] in time order, as (segment, seq, offset, length)"""
+    frames = []
+    with recorder_lock:
+        for segment in sorted(segments, key=lambda segment: segment.seq):
+            if not segment.index or segment.index[-1][0] < start or segment.index[0][0] > end:
+                continue
+            for timestamp, offset, length in segment.index:
+                if start <= timestamp <= end:
+                    frames.append((segment, segment.seq, offset, length))
+    return frames
+
+def read_clip(frames):
+    """Yield recorded frames one by one, stopping if the ring overwrites them
+    or the camera stops (which closes the segments)"""
+    for segment, seq, offset, length in frames:
+        with recorder_lock:
+            if segment.closed or segment.seq != seq:
+                break
+            frame = segment.read(offset, length)
+        yield frame
+
+def schedule_export(start, end):
+    """Export the clip of [start, end] once it is recorded, returns its URL"""
+    name = f"event-{int(start * 1000)}.mjpeg"
+    # A second past the end, so the last frames have reached the ring
+    timer = threading.Timer(max(end - time.time(), 0) + 1, export_clip, (start, end, name))
+    timer.daemon = True
+    timer.start()
+    return f"/camera/exports/{name}"
+
+def export_clip(start, end, name):
+    """Copy recorded frames into their own file, keeping the newest RECORDING_EXPORTS"""
+    frames = recorded_frames(start, end)
+    if not frames:
+        logger.warning(f"No recorded frames for {name}, not exported")
+        return
+    path = os.path.join(RECORDING_EXPORT_DIR, name)
+    try:
+        os.makedirs(RECORDING_EXPORT_DIR, exist_ok=True)
+        with open(path + '.part', 'wb') as f:
+            for frame in read_clip(frames):
+                f.write(frame)
+        os.replace(path + '.part', path)
+        # Names sort by event time
+        exported = sorted(n for n in os.listdir(RECORDING_EXPORT_DIR) if n.endswith('.mjpeg'))
+        for old in exported[:-RECORDING_EXPORTS]:
+            os.remove(os.path.join(RECORDING_EXPORT_DIR, old))
+    except OSError as e:
+        logger.error(f"Failed to export {name}: {e}")
+        return
+    logger.info(f"Exported {name} ({len(frames)} frames)")
+
+def clip_url(start, end):
+    """URL of the recorded clip between two timestamps"""
+    return f"/camera/clip?start={start:.3f}&end={end:.3f}"
+
+def cached_snapshot():
+    """Latest frame if it is fresh enough, else None: (generation, captured_at, frame)"""
+    with frame_ready:
+        if last_frame and time.time() - last_seen_time <= SNAPSHOT_MAX_AGE:
+            return frame_count, last_frame_time, last_frame
+    return None
+
+def get_snapshot():
+    """Latest frame if fresh enough, otherwise the next one: (generation, captured_at, frame)
+    
+    The caller must hold a camera reference. Captures only ever happen on the
+    capture thread, so a burst of snapshot requests adds no camera load.
+    """
+    cached = cached_snapshot()
+    if cached:
+        return cached
+    
+    with frame_ready:
+        seen = frame_count
+    if camera_active:
+        wait_for_frame(seen, SNAPSHOT_WAIT)
+    with frame_ready:
+        if frame_count == seen:
+            # No new frame, don't serve one left over from an earlier session
+            return frame_count, None, None
+        return frame_count, last_frame_time, last_frame
+
+def snapshot_etag(generation, variant):
+    """ETag for a frame generation and variant"""
+    suffix = '-{}x{}q{}'.format(*variant) if variant else ''
+    return f"{ETAG_PREFIX}-{generation}{suffix}"
+
+def render_mock_frames():
+    """Pre-render and encode the synthetic frame cycle as (jpeg, fingerprint) pairs"""
+    if not Image:
+        return [(MOCK_FALLBACK_JPEG, None)]
+    
+    from PIL import ImageDraw
+    width, height = CAMERA_RESOLUTION
+    template = Image.new('RGB', (width, height), color=(50, 50, 50))
+    draw = ImageDraw.Draw(template)
+    
+    # Camera icon and labels, drawn once
+    cx, cy = width // 2, height // 2 - 10
+    draw.rectangle([cx - 50, cy - 50, cx + 50, cy + 50], outline=(100, 100, 100), width=3)
+    draw.ellipse([cx - 25, cy - 30, cx + 25, cy + 20], outline=(100, 100, 100), width=2)
+    draw.text((cx - 40, cy + 80), "Camera Preview", fill=(150, 150, 150))
+    draw.text((cx - 40, cy + 110), f"{width}x{height} @ {CAMERA_FPS} FPS", fill=(100, 100, 100))
+    
+    fps = max(int(CAMERA_FPS), 1)
+    if MOCK_MOTION:
+        count = fps * 9
+    elif MOCK_PATTERN == 'moving':
+        count = fps
+    else:
+        count = 1
+    
+    frames = []
+    box = width // 5
+    for i in range(count):
+        img = template.copy()
         draw = ImageDraw.Draw(img)
-        
-        # Draw camera icon
-        draw.rectangle([270, 190, 370, 290], outline=(100, 100, 100), width=3)
-        draw.ellipse([295, 210, 345, 260], outline=(100, 100, 100), width=2)
-        
-        # Add text
-        draw.text((200, 320), "Camera Preview", fill=(150, 150, 150))
-        draw.text((220, 350), f"Frame: {frame_count}", fill=(100, 100, 100))
-        draw.text((200, 380), time.strftime("%H:%M:%S"), fill=(100, 100, 100))
-        
+        if MOCK_PATTERN == 'moving':
+            # Small marker sweeping along the bottom: every frame differs
+            x = i * (width - 16) // count
+            draw.rectangle([x, height - 24, x + 16, height - 8], fill=(76, 175, 80))
+        if MOCK_MOTION and i < fps * 3:
+            # 3 seconds of a large moving box every 9 seconds
+            x = (i * width // 25) % (width - box)
+            draw.rectangle([x, 40, x + box, 40 + box], fill=(220, 220, 220))
         buffer = io.BytesIO()
         img.save(buffer, format='JPEG', quality=70)
-        return buffer.getvalue()
-        
-    except ImportError:
-        # Minimal 1x1 pixel JPEG
-        return b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00\xff\xdb\x00C\x00\x08\x06\x06\x07\x06\x05\x08\x07\x07\x07\t\t\x08\n\x0c\x14\r\x0c\x0b\x0b\x0c\x19\x12\x13\x0f\x14\x1d\x1a\x1f\x1e\x1d\x1a\x1c\x1c $.\' ",#\x1c\x1c(7),01444\x1f\'9telecom/telecom//444444444444\xff\xc0\x00\x0b\x08\x00\x01\x00\x01\x01\x01\x11\x00\xff\xc4\x00\x1f\x00\x00\x01\x05\x01\x01\x01\x01\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00\x01\x02\x03\x04\x05\x06\x07\x08\t\n\x0b\xff\xc4\x00\xb5\x10\x00\x02\x01\x03\x03\x02\x04\x03\x05\x05\x04\x04\x00\x00\x01}\x01\x02\x03\x00\x04\x11\x05\x12!1A\x06\x13Qa\x07"q\x142\x81\x91\xa1\x08#B\xb1\xc1\x15R\xd1\xf0$3br\x82\t\n\x16\x17\x18\x19\x1a%&\'()*456789:CDEFGHIJSTUVWXYZcdefghijstuvwxyz\x83\x84\x85\x86\x87\x88\x89\x8a\x92\x93\x94\x95\x96\x97\x98\x99\x9a\xa2\xa3\xa4\xa5\xa6\xa7\xa8\xa9\xaa\xb2\xb3\xb4\xb5\xb6\xb7\xb8\xb9\xba\xc2\xc3\xc4\xc5\xc6\xc7\xc8\xc9\xca\xd2\xd3\xd4\xd5\xd6\xd7\xd8\xd9\xda\xe1\xe2\xe3\xe4\xe5\xe6\xe7\xe8\xe9\xea\xf1\xf2\xf3\xf4\xf5\xf6\xf7\xf8\xf9\xfa\xff\xda\x00\x08\x01\x01\x00\x00?\x00\xfb\xd7\xff\xd9'
-
-def generate_mjpeg():
-    """Generate MJPEG stream"""
-    while camera_active:
-        frame = get_frame()
-        if frame:
+        frame = buffer.getvalue()
+        frames.append((frame, jpeg_fingerprint(frame)))
+    return frames
+
+def load_mock_replay(source):
+    """Load a directory of JPEGs or a video file as (jpeg, fingerprint) pairs"""
+    if os.path.isdir(source):
+        names = sorted(name for name in os.listdir(source)
+                       if name.lower().endswith(('.jpg', '.jpeg')))[:MOCK_REPLAY_MAX_FRAMES]
+        frames = []
+        for name in names:
+            with open(os.path.join(source, name), 'rb') as f:
+                frames.append(f.read())
+    else:
+        import cv2 as video
+        capture = video.VideoCapture(source)
+        frames = []
+        while len(frames) < MOCK_REPLAY_MAX_FRAMES:
+            ret, img = capture.read()
+            if not ret:
+                break
+            frames.append(video.imencode('.jpg', img)[1].tobytes())
+        capture.release()
+    
+    if not frames:
+        raise RuntimeError(f"No frames found in {source}")
+    logger.info(f"Mock camera replaying {len(frames)} frames from {source}")
+    return [(frame, jpeg_fingerprint(frame)) for frame in frames]
+
+class MockCamera:
+    """Synthetic camera for testing without hardware
+    
+    Frames are rendered (or loaded from a replay source) and encoded once up
+    front, so reading one costs next to nothing and does not distort load
+    tests. The capture thread paces reads to CAMERA_FPS, or runs flat out
+    when MOCK_REALTIME is off.
+    """
+    
+    def __init__(self, source=None):
+        self.frames = load_mock_replay(source) if source else render_mock_frames()
+        self.index = 0
+    
+    def read(self):
+        """Next (jpeg, fingerprint) in the loop"""
+        frame = self.frames[self.index]
+        self.index = (self.index + 1) % len(self.frames)
+        return frame
+
+def register_viewer(client, variant, max_fps):
+    """Start tracking a stream viewer for /camera/metrics"""
+    global next_viewer_id
+    
+    with metrics_lock:
+        next_viewer_id += 1
+        viewer = {
+            'id': next_viewer_id,
+            'client': client or '',
+            'variant': '{}x{}q{}'.format(*variant) if variant else 'source',
+            'max_fps': max_fps,
+            'frames_sent': 0,
+            'frames_dropped': 0,
+            'fps': 0.0,
+            'window_start': time.monotonic(),
+            'window_frames': 0
+        }
+        viewers[viewer['id']] = viewer
+    return viewer
+
+def viewer_frame_sent(viewer, generation, seen, ready, published_at, write_seconds):
+    """Account for a frame delivered to a viewer
+    
+    `ready` is the newest generation when the viewer's fps cap let it send
+    again (None without a cap). Frames before it were skipped on purpose;
+    only frames missed after it count as dropped.
+    """
+    now = time.monotonic()
+    stage_timings['write'].observe(write_seconds)
+    with metrics_lock:
+        viewer['frames_sent'] += 1
+        viewer['window_frames'] += 1
+        if seen is not None:
+            missed = generation - max(seen + 1, ready or 0)
+            if missed > 0:
+                viewer['frames_dropped'] += missed
+        elapsed = now - viewer['window_start']
+        if elapsed >= VIEWER_FPS_WINDOW:
+            viewer['fps'] = round(viewer['window_frames'] / elapsed, 2)
+            viewer['window_start'] = now
+            viewer['window_frames'] = 0
+
+def unregister_viewer(viewer):
+    """Stop tracking a viewer, keeping its drop count in the totals"""
+    global closed_viewer_drops
+    
+    with metrics_lock:
+        if viewers.pop(viewer['id'], None):
+            closed_viewer_drops += viewer['frames_dropped']
+
+def generate_mjpeg(variant=None, max_fps=None, client=None):
+    """Generate MJPEG stream from the shared frame buffer
+    
+    Always sends the newest frame, so a slow client skips frames instead of
+    building up a backlog.
+    """
+    min_interval = 1.0 / max_fps if max_fps else 0
+    seen = None
+    next_send = 0
+    # Taken here rather than in the route: a generator that never starts
+    # is closed without running its finally block
+    acquire_camera()
+    viewer = register_viewer(client, variant, max_fps)
+    try:
+        while camera_active:
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            generation, frame, published_at = wait_for_frame(seen)
+            if not frame or generation == seen:
+                continue
+            stage_timings['queue'].observe(max(0.0, time.time() - published_at))
+            ready = generation_at(next_send) if min_interval else None
+            next_send = time.monotonic() + min_interval
+            frame = get_variant(variant, generation, frame)
+            started = time.monotonic()
             yield (b'--frame\r\n'
                    b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-        time.sleep(0.033)  # ~30 FPS
+            # Resumed once the server has written the part to the socket
+            viewer_frame_sent(viewer, generation, seen, ready, published_at, time.monotonic() - started)
+            seen = generation
+    finally:
+        unregister_viewer(viewer)
+        release_camera()
 
 def stop_camera():
-    """Stop camera"""
-    global camera, camera_active
+    """Stop camera (the configured Picamera2 object is kept for a fast restart)"""
+    global camera_active, capture_thread, motion_thread
     camera_active = False
     
+    with frame_ready:
+        frame_ready.notify_all()
+    for thread in (capture_thread, motion_thread, recorder_thread):
+        if thread and thread is not threading.current_thread():
+            thread.join(timeout=2)
+    # The next start always gets new threads; one still stuck (e.g. in a
+    # capture) exits once it finds it was replaced
+    capture_thread = motion_thread = None
+    stop_recorder()
+    
     if CAMERA_TYPE == 'picamera2' and camera:
-        camera.stop()
+        if encoder:
+            camera.stop_recording()
+        else:
+            camera.stop()
     elif CAMERA_TYPE == 'opencv' and camera:
+        # Releasing is the only way to stop a USB sensor, it is reopened on start
         camera.release()
     
     logger.info("Camera stopped")
@@ -249,40 +1280,66 @@ def index():
 
 @app.route('/camera/stream')
 def video_stream():
-    """MJPEG video stream"""
-    if not camera_active:
-        init_camera()
+    """MJPEG video stream (optional ?width=&height=&quality=&fps=)"""
+    max_fps = request.args.get('fps', type=float)
+    if max_fps is not None and max_fps <= 0:
+        max_fps = None
     return Response(
-        generate_mjpeg(),
+        generate_mjpeg(parse_variant(request.args), max_fps, request.remote_addr),
         mimetype='multipart/x-mixed-replace; boundary=frame'
     )
 
 @app.route('/camera/snapshot')
 def snapshot():
-    """Single JPEG frame"""
-    frame = get_frame()
+    """Single JPEG frame (optional ?width=&height=&quality=)"""
+    variant = parse_variant(request.args)
+    acquire_camera()
+    try:
+        generation, captured_at, frame = get_snapshot()
+    finally:
+        release_camera()
     if frame:
-        return Response(frame, mimetype='image/jpeg')
+        response = Response(get_variant(variant, generation, frame), mimetype='image/jpeg')
+        response.set_etag(snapshot_etag(generation, variant))
+        response.last_modified = captured_at
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
     return jsonify({'error': 'Failed to capture frame'}), 500
 
 @app.route('/camera/start', methods=['POST'])
 def start_camera():
-    """Start camera"""
-    if not camera_active:
-        init_camera()
+    """Keep the camera running until /camera/stop, even without viewers"""
+    global camera_held
+    
+    with camera_lock:
+        if not camera_held:
+            camera_held = True
+            acquire_camera()
+        active = camera_active
     return jsonify({
-        'success': True,
-        'status': 'active',
+        'success': active,
+        'status': 'active' if active else 'error',
         'camera_type': CAMERA_TYPE or 'mock'
     })
 
 @app.route('/camera/stop', methods=['POST'])
 def stop_camera_route():
-    """Stop camera"""
-    stop_camera()
+    """Release the /camera/start hold; viewers that are still watching keep the camera on"""
+    global camera_held
+    
+    with camera_lock:
+        if camera_held:
+            camera_held = False
+            release_camera()
+        if camera_users == 0 and camera_active:
+            # Explicit stop, skip the idle grace period
+            cancel_idle_timer()
+            stop_camera()
+        consumers = camera_users
     return jsonify({
         'success': True,
-        'status': 'stopped'
+        'status': 'active' if camera_active else 'stopped',
+        'consumers': consumers
     })
 
 @app.route('/camera/status')
@@ -291,9 +1348,172 @@ def camera_status():
     return jsonify({
         'active': camera_active,
         'camera_type': CAMERA_TYPE or 'mock',
-        'frame_count': frame_count
+        'capture_mode': 'hardware-mjpeg' if encoder else 'software',
+        'consumers': camera_users,
+        'frame_count': frame_count,
+        'frames_skipped': frames_skipped,
+        'admission': admission.stats()
+    })
+
+@app.route('/camera/metrics')
+def camera_metrics():
+    """Per-stage latency histograms and viewer counters (Prometheus text format)"""
+    lines = [
+        '# HELP camera_stage_duration_seconds Time spent in each pipeline stage',
+        '# TYPE camera_stage_duration_seconds histogram'
+    ]
+    for stage, histogram in stage_timings.items():
+        lines.extend(histogram.render('camera_stage_duration_seconds', f'stage="{stage}"'))
+    
+    with metrics_lock:
+        current = [dict(viewer) for viewer in viewers.values()]
+        dropped = closed_viewer_drops + sum(viewer['frames_dropped'] for viewer in current)
+        queue_depth = encode_queue_depth + encodes_in_flight
+        encoder_drops = frames_dropped_encoder
+    
+    lines += [
+        '# HELP camera_active Whether the camera is running',
+        '# TYPE camera_active gauge',
+        f'camera_active {int(camera_active)}',
+        '# HELP camera_frames_captured_total Frames published to viewers',
+        '# TYPE camera_frames_captured_total counter',
+        f'camera_frames_captured_total {frame_count}',
+        '# HELP camera_frames_skipped_total Captured frames dropped as duplicates',
+        '# TYPE camera_frames_skipped_total counter',
+        f'camera_frames_skipped_total {frames_skipped}',
+        '# HELP camera_frames_dropped_total Frames viewers missed because they were too slow',
+        '# TYPE camera_frames_dropped_total counter',
+        f'camera_frames_dropped_total {dropped}',
+        '# HELP camera_frames_dropped_encoder_total Captures dropped because the encoders were busy',
+        '# TYPE camera_frames_dropped_encoder_total counter',
+        f'camera_frames_dropped_encoder_total {encoder_drops}',
+        '# HELP camera_encoder_queue_depth Frame and variant encodes running or waiting',
+        '# TYPE camera_encoder_queue_depth gauge',
+        f'camera_encoder_queue_depth {queue_depth}',
+        '# HELP camera_viewers Open stream connections',
+        '# TYPE camera_viewers gauge',
+        f'camera_viewers {len(current)}',
+        '# HELP camera_requests_rejected_total Requests turned away by admission control',
+        '# TYPE camera_requests_rejected_total counter'
+    ]
+    lines += [f'camera_requests_rejected_total{{reason="{reason}"}} {count}'
+              for reason, count in admission.stats()['rejected'].items()]
+    lines += [
+        '# HELP camera_viewer_fps Frames per second achieved by each viewer',
+        '# TYPE camera_viewer_fps gauge'
+    ]
+    labels = {viewer['id']: f'viewer="{viewer["id"]}",client="{viewer["client"]}",variant="{viewer["variant"]}"'
+              for viewer in current}
+    lines += [f'camera_viewer_fps{{{labels[v["id"]]}}} {v["fps"]}' for v in current]
+    lines += [
+        '# HELP camera_viewer_frames_sent_total Frames sent to each viewer',
+        '# TYPE camera_viewer_frames_sent_total counter'
+    ]
+    lines += [f'camera_viewer_frames_sent_total{{{labels[v["id"]]}}} {v["frames_sent"]}' for v in current]
+    lines += [
+        '# HELP camera_viewer_frames_dropped_total Frames each viewer missed because it was too slow',
+        '# TYPE camera_viewer_frames_dropped_total counter'
+    ]
+    lines += [f'camera_viewer_frames_dropped_total{{{labels[v["id"]]}}} {v["frames_dropped"]}' for v in current]
+    
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/camera/motion')
+def camera_motion():
+    """Motion detector state and recent events"""
+    with motion_changed:
+        return jsonify({
+            'enabled': bool(MOTION_ENABLED and np is not None and Image),
+            'running': bool(motion_thread and motion_thread.is_alive()),
+            **motion_state,
+            'version': motion_version,
+            'events': list(motion_events)
+        })
+
+@app.route('/camera/motion/events')
+def camera_motion_events():
+    """Long-poll: wait until a motion event started or ended after ?since=<version>"""
+    since = request.args.get('since', default=motion_version, type=int)
+    timeout = min(max(request.args.get('timeout', default=25, type=float), 0), 60)
+    # Someone waiting for motion needs the camera running
+    acquire_camera()
+    try:
+        with motion_changed:
+            motion_changed.wait_for(lambda: motion_version > since, timeout)
+            return jsonify({
+                'version': motion_version,
+                'active': motion_state['active'],
+                'events': [e for e in motion_events if e['version'] > since]
+            })
+    finally:
+        release_camera()
+
+@app.route('/camera/recording')
+def recording_status():
+    """Rolling recorder status"""
+    with recorder_lock:
+        indexed = [segment.index for segment in segments if segment.index]
+        return jsonify({
+            'enabled': RECORDING_ENABLED,
+            'recording': bool(recorder_thread and recorder_thread.is_alive()),
+            'segments': len(segments),
+            'frames': sum(len(index) for index in indexed),
+            'bytes': sum(segment.used for segment in segments),
+            'oldest': min((index[0][0] for index in indexed), default=None),
+            'newest': max((index[-1][0] for index in indexed), default=None)
+        })
+
+@app.route('/camera/record/event', methods=['POST'])
+def record_event():
+    """Mark an event, returns the clip window around it"""
+    if not RECORDING_ENABLED:
+        return jsonify({'error': 'Recording is disabled'}), 409
+    data = request.get_json(silent=True) or {}
+    try:
+        at = float(data.get('time', time.time()))
+    except (TypeError, ValueError):
+        return jsonify({'error': '"time" must be a Unix timestamp'}), 400
+    start = at - RECORDING_PRE_SECONDS
+    end = at + RECORDING_POST_SECONDS
+    return jsonify({
+        'success': True,
+        'start': start,
+        'end': end,
+        'ready_at': end,
+        'clip': clip_url(start, end),
+        'export': schedule_export(start, end)
     })
 
+@app.route('/camera/clip')
+def camera_clip():
+    """Recorded frames between ?start= and ?end= (Unix timestamps)"""
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    if start is None or end is None or end <= start:
+        return jsonify({'error': 'start and end timestamps are required'}), 400
+    if end - start > RECORDING_MAX_CLIP:
+        return jsonify({'error': f'Clips are limited to {RECORDING_MAX_CLIP} seconds'}), 400
+    
+    frames = recorded_frames(start, end)
+    now = time.time()
+    if end > now and recorder_thread and recorder_thread.is_alive():
+        # The end of the clip has not been recorded yet
+        response = jsonify({'error': 'Clip is still recording', 'ready_at': end})
+        response.headers['Retry-After'] = str(math.ceil(end - now))
+        return response, 409
+    if not frames:
+        return jsonify({'error': 'No recorded frames in that range'}), 404
+    
+    response = Response(read_clip(frames), mimetype='video/x-motion-jpeg')
+    response.headers['Content-Disposition'] = f'attachment; filename="clip-{int(start)}.mjpeg"'
+    return response
+
+@app.route('/camera/exports/<name>')
+def camera_export(name):
+    """An event clip exported out of the recording ring"""
+    return send_from_directory(RECORDING_EXPORT_DIR, name, mimetype='video/x-motion-jpeg',
+                               as_attachment=True)
+
 @app.route('/health')
 def health():
     """Health check"""
@@ -304,11 +1524,173 @@ def health():
         'camera_active': camera_active
     })
 
+# Async serving mode: streams, snapshots and motion long-polls run as
+# coroutines, everything else goes through Flask on a small thread pool
+admission = AdmissionControl(RATE_LIMITS, PRIORITY_PATHS, STREAM_PATHS,
+                             max_streams=MAX_STREAMS, max_requests=MAX_ACTIVE_REQUESTS)
+
+def create_async_server(threads=4):
+    """Build the asyncio server for --async mode"""
+    server = AsyncServer(app, threads=threads, admission=admission,
+                         default_headers={'Access-Control-Allow-Origin': '*'})
+    
+    def parse_max_fps(args):
+        max_fps = args.get('fps', type=float)
+        return max_fps if max_fps and max_fps > 0 else None
+    
+    async def release():
+        """release_camera() off the event loop: camera_lock is held while the
+        camera starts or stops. Shielded, so a cancelled request still releases"""
+        await asyncio.shield(server.run_blocking(release_camera))
+    
+    async def mjpeg_frames(variant, max_fps, client):
+        min_interval = 1.0 / max_fps if max_fps else 0
+        seen = None
+        next_send = 0
+        await server.run_blocking(acquire_camera)
+        viewer = register_viewer(client, variant, max_fps)
+        try:
+            while camera_active:
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                waiter = frame_signal.waiter()
+                with frame_ready:
+                    generation, frame, published_at = frame_count, last_frame, last_frame_time
+                if not frame or generation == seen:
+                    await frame_signal.wait(1.0, waiter)
+                    continue
+                stage_timings['queue'].observe(max(0.0, time.time() - published_at))
+                ready = generation_at(next_send) if min_interval else None
+                next_send = time.monotonic() + min_interval
+                if variant:
+                    frame = await server.run_blocking(get_variant, variant, generation, frame)
+                started = time.monotonic()
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+                viewer_frame_sent(viewer, generation, seen, ready, published_at, time.monotonic() - started)
+                seen = generation
+        finally:
+            unregister_viewer(viewer)
+            await release()
+    
+    @server.route('/camera/stream')
+    async def stream(req):
+        return AsyncResponse(mjpeg_frames(parse_variant(req.args), parse_max_fps(req.args), req.remote_addr),
+                             content_type='multipart/x-mixed-replace; boundary=frame')
+    
+    @server.route('/camera/snapshot')
+    async def snapshot(req):
+        variant = parse_variant(req.args)
+        await server.run_blocking(acquire_camera)
+        try:
+            generation, captured_at, frame = cached_snapshot() or await server.run_blocking(get_snapshot)
+        finally:
+            await release()
+        if not frame:
+            return AsyncResponse.json({'error': 'Failed to capture frame'}, 500)
+        
+        etag = snapshot_etag(generation, variant)
+        headers = {
+            'ETag': f'"{etag}"',
+            'Last-Modified': formatdate(captured_at, usegmt=True),
+            'Cache-Control': 'no-cache'
+        }
+        if_none_match = req.headers.get('if-none-match')
+        if_modified_since = req.headers.get('if-modified-since')
+        if if_none_match:
+            not_modified = f'"{etag}"' in if_none_match or if_none_match.strip() == '*'
+        elif if_modified_since:
+            try:
+                not_modified = parsedate_to_datetime(if_modified_since).timestamp() >= int(captured_at)
+            except (TypeError, ValueError):
+                not_modified = False
+        else:
+            not_modified = False
+        if not_modified:
+            return AsyncResponse(b'', 304, headers)
+        
+        if variant:
+            frame = await server.run_blocking(get_variant, variant, generation, frame)
+        return AsyncResponse(frame, headers=headers, content_type='image/jpeg')
+    
+    @server.route('/camera/motion/events')
+    async def motion_events_poll(req):
+        since = req.args.get('since', default=motion_version, type=int)
+        timeout = min(max(req.args.get('timeout', default=25, type=float), 0), 60)
+        deadline = time.monotonic() + timeout
+        await server.run_blocking(acquire_camera)
+        try:
+            while motion_version <= since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                waiter = motion_signal.waiter()
+                if motion_version > since:
+                    break
+                await motion_signal.wait(remaining, waiter)
+        finally:
+            await release()
+        with motion_changed:
+            return AsyncResponse.json({
+                'version': motion_version,
+                'active': motion_state['active'],
+                'events': [e for e in motion_events if e['version'] > since]
+            })
+    
+    return server
+
+def handle_sigterm(signum, frame):
+    """Stop the development server like Ctrl+C, so cleanup still runs"""
+    raise KeyboardInterrupt
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SmartHome Camera Server')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='production mode: streams on an asyncio event loop, other requests on a fixed thread pool')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='worker threads for regular requests in --async mode')
+    parser.add_argument('--max-streams', type=int, help=f'open streams allowed (default {MAX_STREAMS})')
+    parser.add_argument('--resolution', help='capture resolution, e.g. 1280x720')
+    parser.add_argument('--fps', type=float, help='capture frame rate')
+    parser.add_argument('--mock', action='store_true', help='use the mock camera even if a real one is available')
+    parser.add_argument('--mock-source', help='directory of JPEGs or a video file for the mock camera to replay')
+    parser.add_argument('--mock-pattern', choices=['moving', 'static'], help='synthetic mock frames')
+    parser.add_argument('--mock-motion', action='store_true', help='add periodic motion to synthetic mock frames')
+    parser.add_argument('--max-speed', action='store_true', help='mock camera produces frames as fast as possible')
+    parser.add_argument('--record', action='store_true', help='keep a rolling recording and export event clips')
+    args = parser.parse_args()
+    
+    if args.max_streams:
+        admission.max_streams = args.max_streams
+    if args.resolution:
+        CAMERA_RESOLUTION = tuple(int(v) for v in args.resolution.lower().split('x'))
+    if args.fps:
+        CAMERA_FPS = args.fps
+    if args.mock or args.mock_source:
+        CAMERA_TYPE = None
+    if args.mock_source:
+        MOCK_SOURCE = args.mock_source
+    if args.mock_pattern:
+        MOCK_PATTERN = args.mock_pattern
+    if args.mock_motion:
+        MOCK_MOTION = True
+    if args.max_speed:
+        MOCK_REALTIME = False
+    if args.record:
+        RECORDING_ENABLED = True
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    
     try:
-        init_camera()
+        if RECORDING_ENABLED:
+            # The recorder is a permanent consumer, everything else starts the camera on demand
+            acquire_camera()
         logger.info("Starting SmartHome Camera Server on port 8081...")
-        app.run(host='0.0.0.0', port=8081, threaded=True)
+        if args.use_async:
+            create_async_server(args.threads).run('0.0.0.0', 8081)
+        else:
+            install_flask(admission, app)
+            app.run(host='0.0.0.0', port=8081, threaded=True)
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     finally:
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Fake Firebase Realtime Database for running schedule_checker.py offline
+
+Keeps one JSON tree in memory and serves the part of the REST API the
+checker uses, including event streams:
+
+    GET    /<path>.json    read (with Accept: text/event-stream, follow changes;
+                           X-Firebase-ETag / If-None-Match work as in Firebase)
+    PUT    /<path>.json    replace
+    PATCH  /<path>.json    update children
+    DELETE /<path>.json    remove
+    POST   /.disconnect    close every open stream (to test reconnects)
+
+Usage:
+    python fake_firebase.py --data schedules.json --port 9000
+    python schedule_checker.py --database-url http://127.0.0.1:9000
+
+    curl -X PATCH http://127.0.0.1:9000/schedules/user1/wake.json -d '{"time": "07:00"}'
+"""
+
+import argparse
+import hashlib
+import json
+import queue
+import threading
+
+from flask import Flask, Response, request
+from werkzeug.serving import WSGIRequestHandler
+
+KEEP_ALIVE = 30  # seconds, like Firebase
+
+app = Flask(__name__)
+tree = None
+tree_lock = threading.Lock()
+streams = []  # one queue per open stream, receives (event, path parts, data)
+
+
+def split(path):
+    return [part for part in path.split('/') if part]
+
+
+def get_path(node, parts):
+    for part in parts:
+        if isinstance(node, list) and part.isdigit() and int(part) < len(node):
+            node = node[int(part)]
+        elif isinstance(node, dict):
+            node = node.get(part)
+        else:
+            return None
+    return node
+
+
+def set_path(node, parts, value):
+    """Copy of `node` with `value` at `parts`; None deletes, empty parents disappear"""
+    if not parts:
+        return value
+    if isinstance(node, list) and parts[0].isdigit():
+        items = list(node)
+        index = int(parts[0])
+        items.extend([None] * (index + 1 - len(items)))
+        items[index] = set_path(items[index], parts[1:], value)
+        while items and items[-1] is None:
+            items.pop()
+        return items or None
+    node = dict(node) if isinstance(node, dict) else {}
+    child = set_path(node.get(parts[0]), parts[1:], value)
+    if child is None:
+        node.pop(parts[0], None)
+    else:
+        node[parts[0]] = child
+    return node or None
+
+
+def publish(event, parts, data):
+    for stream in list(streams):
+        stream.put((event, parts, data))
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def follow(parts):
+    """Event stream of the tree at `parts`: a put of everything, then changes"""
+    stream = queue.Queue()
+    with tree_lock:
+        streams.append(stream)
+        first = format_event('put', {'path': '/', 'data': get_path(tree, parts)})
+
+    def generate():
+        try:
+            yield first
+            while True:
+                try:
+                    change = stream.get(timeout=KEEP_ALIVE)
+                except queue.Empty:
+                    yield "event: keep-alive\ndata: null\n\n"
+                    continue
+                if change is None:
+                    return
+                event, changed, data = change
+                if changed[:len(parts)] == parts:
+                    path = '/' + '/'.join(changed[len(parts):])
+                    yield format_event(event, {'path': path, 'data': data})
+                elif parts[:len(changed)] == changed:
+                    # A parent of the followed location changed
+                    with tree_lock:
+                        data = get_path(tree, parts)
+                    yield format_event('put', {'path': '/', 'data': data})
+        finally:
+            streams.remove(stream)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/', defaults={'path': ''}, methods=['GET', 'PUT', 'PATCH', 'DELETE'])
+@app.route('/<path:path>', methods=['GET', 'PUT', 'PATCH', 'DELETE'])
+def database(path):
+    global tree
+    if not path.endswith('.json') and path:
+        return Response('{"error": "404 Not Found"}', status=404, mimetype='application/json')
+    parts = split(path[:-len('.json')] if path else '')
+
+    if request.method == 'GET':
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            return follow(parts)
+        with tree_lock:
+            body = json.dumps(get_path(tree, parts))
+        headers = {}
+        if request.headers.get('X-Firebase-ETag') == 'true':
+            etag = hashlib.sha1(body.encode()).hexdigest()
+            if request.headers.get('If-None-Match') == etag:
+                return Response(status=304)
+            headers['ETag'] = etag
+        return Response(body, mimetype='application/json', headers=headers)
+
+    data = None if request.method == 'DELETE' else json.loads(request.get_data() or 'null')
+    with tree_lock:
+        if request.method == 'PATCH':
+            if not isinstance(data, dict):
+                return Response('{"error": "PATCH needs an object"}', status=400, mimetype='application/json')
+            for key, value in data.items():
+                tree = set_path(tree, parts + split(key), value)
+        else:
+            tree = set_path(tree, parts, data)
+        publish('patch' if request.method == 'PATCH' else 'put', parts, data)
+    return Response(json.dumps(data), mimetype='application/json')
+
+
+@app.route('/.disconnect', methods=['POST'])
+def disconnect():
+    open_streams = list(streams)
+    for stream in open_streams:
+        stream.put(None)
+    return {'closed': len(open_streams)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Firebase Realtime Database')
+    parser.add_argument('--data', help='JSON file with the initial tree, e.g. {"schedules": {...}}')
+    parser.add_argument('--port', type=int, default=9000)
+    args = parser.parse_args()
+
+    if args.data:
+        with open(args.data) as f:
+            tree = json.load(f)
+    # HTTP/1.1, so streams are sent chunked like Firebase's
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    app.run(host='127.0.0.1', port=args.port, threaded=True, use_reloader=False)
@@ -8,18 +8,35 @@ Endpoints:
 - GET  /health   : Health check (JSON)
 - GET  /led      : Get current LED state
 - POST /led      : Set LED state (body: {"state": "ON" or "OFF"})
+- GET  /devices  : State of every registered device
+- GET  /devices/<name>  : State of one device
+- POST /devices/<name>  : Set one device (body: {"state": "ON" or "OFF"}, or for
+                          pwm devices {"brightness": 0-100, "duration": <fade seconds>})
+- POST /devices/batch   : Set many devices at once
+                          (body: {"devices": {"<name>": "ON", ...}} and/or {"all": "OFF"})
+- GET  /events   : Long-poll for state changes after ?since=<version>
+- GET  /events/stream   : Server-Sent Events feed of state changes
 
 Hardware:
 - LED connected to GPIO 18 (BCM numbering)
 - LED anode (+) -> GPIO 18
 - LED cathode (-) -> 220Ω resistor -> GND
+- More LEDs/relays are listed in devices.json (see devices.example.json)
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
+import argparse
+import signal
 import time
+import json
+import os
 import logging
 import threading
+import zlib
+from collections import deque
+from async_server import AsyncServer, AsyncResponse, Signal
+from admission import AdmissionControl, install_flask
 
 # Configure logging
 logging.basicConfig(
@@ -49,45 +66,578 @@ CORS(app, resources={
 
 # Configuration
 LED_PIN = 18
-led_state = False
-last_updated = None
+DEFAULT_DEVICE = 'led'  # Device behind /led
+# Device registry: {"name": {"pin": 18, "mode": "led"}, ...}
+DEVICES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "devices.json")
+# Relay boards are usually switched on by pulling the pin LOW; pwm devices are dimmable
+DEVICE_MODES = {'led': False, 'relay': True, 'pwm': False}  # mode -> active low
+PWM_FREQUENCY = 200  # Hz
+PWM_GAMMA = 2.2  # Brightness -> duty cycle curve, so fades look even to the eye
+FADE_STEP = 0.01  # Seconds between fade updates
+FADE_MIN_CHANGE = 0.1  # Brightness percent; smaller changes are not written
+MAX_FADE_DURATION = 24 * 3600
+# Commands arriving this soon after the last write are merged into one write
+COALESCE_WINDOW = 0.1  # seconds, 0 disables
+# Append-only journal of device states, replayed on startup (None disables)
+STATE_JOURNAL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "led_state.journal")
+JOURNAL_FSYNC_DELAY = 0.5  # Changes within this many seconds share one fsync
+JOURNAL_COMPACT_SIZE = 256 * 1024  # Rewrite as a single snapshot past this size
+CHANGE_HISTORY = 256  # Changes kept for clients resuming from an older version
+EVENT_KEEPALIVE = 15  # Seconds between keep-alive comments on idle event streams
+# Admission control: (method, path, requests/s, burst) per client and endpoint, first match wins
+RATE_LIMITS = [
+    ('POST', '/led', 5, 10),
+    ('POST', '/devices*', 5, 10),
+    ('GET', '/events*', 1, 5),
+    ('GET', '/*', 20, 40),
+]
+PRIORITY_PATHS = ['/health', '/led', '/devices*']  # Reads that skip the caps below
+MAX_SUBSCRIBERS = 100  # Open change feed connections (long-polls and SSE)
+MAX_ACTIVE_REQUESTS = 16  # Other requests in progress before new ones get a 503
 gpio_lock = threading.Lock()
 
+# Change feed, guarded by gpio_lock: every set_devices() call is one version
+state_version = 0
+state_changes = deque(maxlen=CHANGE_HISTORY)
+state_changed = threading.Condition(gpio_lock)
+state_signal = Signal()
+
+# Command queue, guarded by command_lock (taken before gpio_lock)
+command_lock = threading.Lock()
+pending_commands = {}  # name -> latest (brightness, duration)
+pending_callers = []   # {'changes', 'done', 'result', 'error'} waiting for the next flush
+flush_timer = None
+last_flush = 0.0
+
+# State journal: records are queued under gpio_lock, written by journal_thread
+journal_thread = None
+journal_file = None
+journal_queue = []
+journal_closed = False
+journal_ready = threading.Condition(gpio_lock)
+
+# Fade scheduler, guarded by gpio_lock: one thread drives every active fade
+fade_thread = None
+fade_wakeup = threading.Condition(gpio_lock)
+
+def load_devices(path=DEVICES_FILE):
+    """Device registry from the config file, or the single LED on LED_PIN"""
+    config = {DEFAULT_DEVICE: {'pin': LED_PIN, 'mode': 'led'}}
+    if os.path.exists(path):
+        with open(path) as f:
+            config = json.load(f)
+    
+    registry = {}
+    pins = set()
+    for name, spec in config.items():
+        if name == 'batch':
+            raise ValueError("'batch' is reserved for /devices/batch")
+        mode = spec.get('mode', 'led')
+        if mode not in DEVICE_MODES:
+            raise ValueError(f"Device {name}: unknown mode {mode!r}")
+        pin = int(spec['pin'])
+        if pin in pins:
+            raise ValueError(f"Device {name}: pin {pin} is already in use")
+        pins.add(pin)
+        registry[name] = {
+            'pin': pin,
+            'mode': mode,
+            'active_low': bool(spec.get('active_low', DEVICE_MODES[mode])),
+            'state': False,
+            'brightness': 0.0,       # Target brightness in percent
+            'on_brightness': 100.0,  # Brightness "ON" restores
+            'level': 0.0,            # Brightness currently driven
+            'fade': None,
+            'pwm': None,
+            'last_updated': None
+        }
+    if not registry:
+        raise ValueError(f"No devices configured in {path}")
+    return registry
+
+devices = load_devices()
+default_device = DEFAULT_DEVICE if DEFAULT_DEVICE in devices else next(iter(devices))
+
+def pin_level(device, state):
+    """GPIO level that puts a device in `state`"""
+    return GPIO.HIGH if state != device['active_low'] else GPIO.LOW
+
 def setup_gpio():
-    """Initialize GPIO pins"""
+    """Initialize GPIO pins in their restored state (off unless restore_state() ran)"""
     if GPIO_AVAILABLE:
         with gpio_lock:
             GPIO.setmode(GPIO.BCM)
             GPIO.setwarnings(False)
-            GPIO.setup(LED_PIN, GPIO.OUT)
-            GPIO.output(LED_PIN, GPIO.LOW)
-        logger.info(f"GPIO initialized, LED on pin {LED_PIN}")
+            for device in devices.values():
+                GPIO.setup(device['pin'], GPIO.OUT, initial=pin_level(device, device['state']))
+                if device['mode'] == 'pwm':
+                    device['pwm'] = GPIO.PWM(device['pin'], PWM_FREQUENCY)
+                    device['pwm'].start(duty_cycle(device, device['level']))
+        logger.info("GPIO initialized: " + ", ".join(f"{name} on pin {device['pin']}"
+                                                     for name, device in devices.items()))
+
+def duty_cycle(device, level):
+    """PWM duty cycle that drives a device at `level` percent brightness"""
+    duty = 100 * (level / 100) ** PWM_GAMMA
+    return 100 - duty if device['active_low'] else duty
+
+def write_level(device, level):
+    """Drive a pwm device at `level` percent (call with gpio_lock held)"""
+    device['level'] = level
+    if device['pwm']:
+        device['pwm'].ChangeDutyCycle(duty_cycle(device, level))
+
+def device_info(name):
+    """JSON view of a device"""
+    device = devices[name]
+    fade = device['fade']
+    return {
+        'name': name,
+        'pin': device['pin'],
+        'mode': device['mode'],
+        'state': 'ON' if device['state'] else 'OFF',
+        'is_on': device['state'],
+        'brightness': round(device['brightness'], 1),
+        'fade': fade and {
+            'from': round(fade['from'], 1),
+            'to': round(fade['to'], 1),
+            'duration': round(fade['end'] - fade['start'], 3),
+            'ends_at': fade['ends_at']
+        },
+        'last_updated': device['last_updated']
+    }
+
+def parse_state(value):
+    """True/False for "ON"/"OFF" (any case), None if invalid"""
+    value = str(value).upper()
+    if value not in ('ON', 'OFF'):
+        return None
+    return value == 'ON'
+
+def parse_command(name, value):
+    """(brightness, fade seconds) for a device from "ON"/"OFF" or a
+    {"state", "brightness", "duration"} object; ValueError if invalid"""
+    device = devices[name]
+    if not isinstance(value, dict):
+        value = {'state': value}
+    if 'state' not in value and 'brightness' not in value:
+        raise ValueError('Missing "state" field')
+    
+    state = parse_state(value.get('state', 'ON'))
+    if state is None:
+        raise ValueError('State must be "ON" or "OFF"')
+    brightness = value.get('brightness')
+    duration = value.get('duration', 0)
+    if (brightness is not None or duration) and device['mode'] != 'pwm':
+        raise ValueError(f'"{name}" is not dimmable, only "state" is supported')
+    
+    if brightness is not None:
+        if isinstance(brightness, bool) or not isinstance(brightness, (int, float)) or not 0 <= brightness <= 100:
+            raise ValueError('"brightness" must be a number from 0 to 100')
+    if isinstance(duration, bool) or not isinstance(duration, (int, float)) or not 0 <= duration <= MAX_FADE_DURATION:
+        raise ValueError(f'"duration" must be 0 to {MAX_FADE_DURATION} seconds')
+    
+    if not state:
+        brightness = 0
+    elif brightness is None:
+        brightness = device['on_brightness']
+    return float(brightness), float(duration)
+
+def describe_command(name, brightness, duration):
+    """Log text for a command"""
+    if devices[name]['mode'] != 'pwm':
+        return f"{name} {'ON' if brightness else 'OFF'}"
+    fade = f" over {duration:g}s" if duration else ""
+    return f"{name} {brightness:g}%{fade}"
+
+def publish_changes(names):
+    """Record the current state of `names` as a new version (call with gpio_lock held)"""
+    global state_version
+    result = {name: device_info(name) for name in names}
+    state_version += 1
+    state_changes.append({'type': 'change', 'version': state_version, 'time': time.time(), 'devices': result})
+    state_changed.notify_all()
+    state_signal.notify()
+    if journal_thread:
+        journal_queue.append(journal_record(names))
+        journal_ready.notify()
+    return result
+
+def is_noop(device, brightness, duration):
+    """True if a command would leave the device as it is (call with gpio_lock held)"""
+    # A fade to the current target keeps running; an instant command cancels it
+    return brightness == device['brightness'] and (duration > 0 or device['fade'] is None)
+
+def set_devices(commands):
+    """Apply {name: (brightness, fade seconds)} under one lock acquisition (thread-safe)
+    
+    Commands that change nothing are skipped. On/off pins are written in a
+    single GPIO call; fades are handed to the fade thread, replacing any fade
+    already running on the device. Returns (device_info of every named
+    device, read before the lock is released, set of names that changed);
+    changes are published to the change feed as one new version.
+    """
+    with gpio_lock:
+        changes = {name: command for name, command in commands.items()
+                   if not is_noop(devices[name], *command)}
+        if not changes:
+            return {name: device_info(name) for name in commands}, set()
+        
+        now = time.monotonic()
+        updated = time.strftime("%Y-%m-%d %H:%M:%S")
+        switched = []
+        fading = False
+        for name, (brightness, duration) in changes.items():
+            device = devices[name]
+            device['state'] = brightness > 0
+            device['brightness'] = brightness
+            if brightness > 0:
+                device['on_brightness'] = brightness
+            device['last_updated'] = updated
+            
+            if duration:
+                # Start from wherever the output is now, even mid-fade
+                start = fade_level(device['fade'], now) if device['fade'] else device['level']
+                device['fade'] = {'from': start, 'to': brightness, 'start': now,
+                                  'end': now + duration, 'ends_at': time.time() + duration}
+                fading = True
+            elif device['mode'] == 'pwm':
+                device['fade'] = None
+                write_level(device, brightness)
+            else:
+                device['level'] = brightness
+                switched.append(device)
+        
+        if GPIO_AVAILABLE and switched:
+            GPIO.output([device['pin'] for device in switched],
+                        [pin_level(device, device['state']) for device in switched])
+        if fading:
+            start_fade_thread()
+        publish_changes(changes)
+        result = {name: device_info(name) for name in commands}
+    
+    logger.info("Set " + ", ".join(describe_command(name, *command) for name, command in changes.items()))
+    return result, set(changes)
+
+def submit_commands(commands):
+    """Apply commands through the queue, returning ({name: info}, {name: result})
+    
+    A command arriving while the GPIO layer is quiet is applied at once.
+    Commands arriving within COALESCE_WINDOW of the last write are held and
+    merged, so a burst only writes each device's final state. Every result
+    is "applied", "unchanged" (no-op) or "coalesced" (replaced by a later
+    command before it was written); infos are the state after the write.
+    """
+    global flush_timer, last_flush
+    
+    with command_lock:
+        now = time.monotonic()
+        if flush_timer is None and now - last_flush >= COALESCE_WINDOW:
+            last_flush = now
+            info, changed = set_devices(commands)
+            return info, {name: 'applied' if name in changed else 'unchanged' for name in commands}
+        
+        if not any(name in pending_commands for name in commands):
+            # Repeats of the current state need no write, so they need not wait for one
+            with gpio_lock:
+                if all(is_noop(devices[name], *command) for name, command in commands.items()):
+                    return ({name: device_info(name) for name in commands},
+                            dict.fromkeys(commands, 'unchanged'))
+        
+        caller = {'changes': commands, 'done': threading.Event(), 'result': None, 'error': None}
+        pending_commands.update(commands)
+        pending_callers.append(caller)
+        if flush_timer is None:
+            flush_timer = threading.Timer(max(0, last_flush + COALESCE_WINDOW - now), flush_commands)
+            flush_timer.daemon = True
+            flush_timer.start()
+    
+    caller['done'].wait()
+    if caller['error']:
+        raise caller['error']
+    return caller['result']
+
+def flush_commands():
+    """Write the merged pending commands and answer everyone waiting on them
+    
+    If the write fails, every waiting caller gets the error (their requests
+    answer 500) instead of waiting forever.
+    """
+    global flush_timer, last_flush
+    
+    with command_lock:
+        commands = dict(pending_commands)
+        callers = list(pending_callers)
+        pending_commands.clear()
+        pending_callers.clear()
+        flush_timer = None
+        last_flush = time.monotonic()
+        try:
+            info, changed = set_devices(commands)
+            if len(callers) > 1:
+                logger.debug(f"Coalesced {len(callers)} commands into one write")
+            for caller in callers:
+                results = {}
+                for name, command in caller['changes'].items():
+                    if command is not commands[name]:
+                        results[name] = 'coalesced'
+                    else:
+                        results[name] = 'applied' if name in changed else 'unchanged'
+                caller['result'] = ({name: info[name] for name in caller['changes']}, results)
+        except Exception as e:
+            logger.error(f"Error applying queued commands: {e}")
+            for caller in callers:
+                caller['error'] = e
+        finally:
+            for caller in callers:
+                caller['done'].set()
+
+def fade_level(fade, now):
+    """Brightness of a fade at monotonic time `now`"""
+    if now >= fade['end']:
+        return fade['to']
+    progress = (now - fade['start']) / (fade['end'] - fade['start'])
+    return fade['from'] + (fade['to'] - fade['from']) * progress
+
+def start_fade_thread():
+    """Start the fade thread, or wake it for a new fade (call with gpio_lock held)"""
+    global fade_thread
+    if fade_thread is None:
+        fade_thread = threading.Thread(target=fade_loop, name='fades', daemon=True)
+        fade_thread.start()
+    else:
+        fade_wakeup.notify()
+
+def fade_loop():
+    """Drive every active fade from one thread until none are left
+    
+    Levels are computed from the clock on each tick, so a late tick skips a
+    step instead of stretching the fade, and every fade ends on time.
+    """
+    global fade_thread
+    
+    next_tick = time.monotonic()
+    with gpio_lock:
+        while True:
+            now = time.monotonic()
+            finished = []
+            for name, device in devices.items():
+                fade = device['fade']
+                if not fade:
+                    continue
+                level = fade_level(fade, now)
+                if now >= fade['end']:
+                    write_level(device, level)
+                    device['fade'] = None
+                    finished.append(name)
+                elif abs(level - device['level']) >= FADE_MIN_CHANGE:
+                    write_level(device, level)
+            if finished:
+                publish_changes(finished)
+                logger.info("Fade finished: " + ", ".join(finished))
+            
+            if not any(device['fade'] for device in devices.values()):
+                fade_thread = None
+                return
+            next_tick = max(next_tick + FADE_STEP, now)
+            fade_wakeup.wait(next_tick - time.monotonic())
+
+def changes_since(since):
+    """Change events after version `since` (call with gpio_lock held)
+    
+    A client without a version, one that fell further behind than
+    CHANGE_HISTORY, or one holding a version from before a restart gets a
+    single snapshot event with every device instead.
+    """
+    if since == state_version:
+        return []
+    if since is not None and since < state_version and state_changes and state_changes[0]['version'] <= since + 1:
+        return [change for change in state_changes if change['version'] > since]
+    return [{
+        'type': 'snapshot',
+        'version': state_version,
+        'time': time.time(),
+        'devices': {name: device_info(name) for name in devices}
+    }]
+
+def sse_event(change):
+    """Server-Sent Events encoding of a change event"""
+    return f"id: {change['version']}\nevent: {change['type']}\ndata: {json.dumps(change)}\n\n".encode()
+
+def event_args(args, headers):
+    """(since, timeout) of a feed request; ?since= wins over Last-Event-ID"""
+    since = args.get('since', type=int)
+    if since is None and headers.get('Last-Event-ID', '').isdigit():
+        since = int(headers['Last-Event-ID'])
+    timeout = min(max(args.get('timeout', default=25, type=float), 0), 60)
+    return since, timeout
 
 def set_led(state):
     """Set LED state (thread-safe)"""
-    global led_state, last_updated
+    command = parse_command(default_device, 'ON' if state else 'OFF')
+    return submit_commands({default_device: command})[0][default_device]
+
+def journal_record(names):
+    """Journal entry with the saved state of `names` (call with gpio_lock held)
+    
+    Fades are saved as their target, so a restart mid-fade restores the end state.
+    """
+    return {
+        'version': state_version,
+        'time': time.time(),
+        'devices': {name: {
+            'brightness': devices[name]['brightness'],
+            'on_brightness': devices[name]['on_brightness'],
+            'last_updated': devices[name]['last_updated']
+        } for name in names}
+    }
+
+def encode_record(record):
+    """One journal line: CRC32 of the JSON, then the JSON"""
+    data = json.dumps(record, separators=(',', ':')).encode()
+    return b'%08x %s\n' % (zlib.crc32(data), data)
+
+def read_journal(path):
+    """(records, bytes) of the intact part of a journal
+    
+    Reading stops at the first torn or corrupt line, which is what a crash
+    in the middle of an append leaves behind.
+    """
+    records = []
+    size = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            crc, _, data = line.rstrip(b'\n').partition(b' ')
+            try:
+                if not line.endswith(b'\n') or int(crc, 16) != zlib.crc32(data):
+                    break
+                records.append(json.loads(data))
+            except ValueError:
+                break
+            size += len(line)
+    return records, size
+
+def restore_state():
+    """Replay the journal into `devices`; run before setup_gpio() and serving"""
+    global state_version
+    
+    if not STATE_JOURNAL or not os.path.exists(STATE_JOURNAL):
+        return
+    records, size = read_journal(STATE_JOURNAL)
+    if size < os.path.getsize(STATE_JOURNAL):
+        logger.warning(f"Ignoring damaged tail of {STATE_JOURNAL} after {len(records)} records")
     
     with gpio_lock:
-        led_state = state
-        last_updated = time.strftime("%Y-%m-%d %H:%M:%S")
+        for record in records:
+            state_version = record['version']
+            for name, saved in record['devices'].items():
+                device = devices.get(name)
+                if device is None:
+                    continue  # No longer configured
+                brightness = saved['brightness']
+                if device['mode'] != 'pwm':
+                    brightness = 100.0 if brightness else 0.0
+                device['state'] = brightness > 0
+                device['brightness'] = device['level'] = brightness
+                device['on_brightness'] = saved['on_brightness']
+                device['last_updated'] = saved['last_updated']
+    if records:
+        logger.info("Restored " + ", ".join(describe_command(name, devices[name]['brightness'], 0)
+                                            for name in devices) + f" (version {state_version})")
+
+def open_journal():
+    """Start journaling changes, beginning with a snapshot of the current state"""
+    global journal_thread, journal_closed
+    
+    if not STATE_JOURNAL:
+        return
+    compact_journal()
+    journal_closed = False
+    journal_thread = threading.Thread(target=journal_loop, name='journal', daemon=True)
+    journal_thread.start()
+
+def compact_journal():
+    """Replace the journal with one snapshot record of every device
+    
+    The snapshot is written to a temporary file and renamed over the
+    journal, so a crash at any point leaves either the old or the new one.
+    """
+    global journal_file
+    
+    with gpio_lock:
+        record = journal_record(devices)
+        # Everything still queued is older than the snapshot
+        journal_queue.clear()
+    
+    temp = STATE_JOURNAL + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(encode_record(record))
+        f.flush()
+        os.fsync(f.fileno())
+    if journal_file:
+        journal_file.close()
+    os.replace(temp, STATE_JOURNAL)
+    directory = os.open(os.path.dirname(STATE_JOURNAL) or '.', os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+    journal_file = open(STATE_JOURNAL, 'ab')
+
+def journal_loop():
+    """Append queued records, fsyncing once per JOURNAL_FSYNC_DELAY at most"""
+    global journal_file
+    
+    while True:
+        with gpio_lock:
+            journal_ready.wait_for(lambda: journal_queue or journal_closed)
+            # Let a burst of changes share the write and the fsync
+            journal_ready.wait_for(lambda: journal_closed, JOURNAL_FSYNC_DELAY)
+            records = list(journal_queue)
+            journal_queue.clear()
+            closing = journal_closed
+        
+        try:
+            if records:
+                journal_file.write(b''.join(encode_record(record) for record in records))
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            if journal_file.tell() > JOURNAL_COMPACT_SIZE:
+                compact_journal()
+        except OSError as e:
+            logger.error(f"State journal write failed: {e}")
         
-        if GPIO_AVAILABLE:
-            GPIO.output(LED_PIN, GPIO.HIGH if state else GPIO.LOW)
+        if closing:
+            journal_file.close()
+            journal_file = None
+            return
+
+def close_journal():
+    """Write out pending records and stop the journal thread"""
+    global journal_thread, journal_closed
     
-    logger.info(f"LED set to {'ON' if state else 'OFF'}")
+    if journal_thread is None:
+        return
+    with gpio_lock:
+        journal_closed = True
+        journal_ready.notify()
+    journal_thread.join(timeout=5)
+    journal_thread = None
 
 def cleanup_gpio():
     """Cleanup GPIO on exit"""
     if GPIO_AVAILABLE:
         with gpio_lock:
+            for device in devices.values():
+                device['fade'] = None
+                if device['pwm']:
+                    device['pwm'].stop()
+                    device['pwm'] = None
             GPIO.cleanup()
         logger.info("GPIO cleaned up")
 
-# Routes
-@app.route('/')
-def index():
-    """Web interface"""
-    html = f"""
+# Web interface: everything but the LED state is rendered once at import
+INDEX_HEAD = f"""
     <!DOCTYPE html>
     <html>
     <head>
@@ -166,14 +716,14 @@ def index():
         <div class="card">
             <h1>💡 LED Control</h1>
             <p>SmartHome IoT Server</p>
-            <div class="status {'on' if led_state else 'off'}">
-                {'🌟 ON' if led_state else '⚫ OFF'}
-            </div>
+"""
+INDEX_BUTTONS = """
             <div>
                 <button class="btn-on" onclick="setLed(true)">Turn ON</button>
                 <button class="btn-off" onclick="setLed(false)">Turn OFF</button>
             </div>
-            <p class="time">Last updated: {last_updated or 'Never'}</p>
+"""
+INDEX_TAIL = f"""
             <p class="mode">Mode: {'GPIO' if GPIO_AVAILABLE else 'Mock (no GPIO)'}</p>
         </div>
         <script>
@@ -195,28 +745,81 @@ def index():
     </body>
     </html>
     """
-    return html
+# Bodies of GET /, /led and /health, served with ETags so unchanged polls get a 304
+ETAG_PREFIX = f"{int(time.time()):x}"
+HEALTH_ETAG = f"{ETAG_PREFIX}-health"
 
-@app.route('/health', methods=['GET'])
-def health():
-    """Health check endpoint (quick response)"""
-    return jsonify({
+def render_health():
+    """GET /health body (it only changes with the configuration)"""
+    return json.dumps({
         'status': 'ok',
         'gpio_available': GPIO_AVAILABLE,
-        'led_pin': LED_PIN,
+        'led_pin': devices[default_device]['pin'],
+        'devices': len(devices),
         'server': 'SmartHome IoT LED Server',
         'version': '1.1.0'
-    })
+    }).encode()
+
+HEALTH_BODY = render_health()
+response_cache = {}  # key -> (state version, etag, body)
+
+def render_index():
+    """Web page for the current state (call with gpio_lock held)"""
+    led = devices[default_device]
+    return ''.join((
+        INDEX_HEAD,
+        f"""            <div class="status {'on' if led['state'] else 'off'}">
+                {'🌟 ON' if led['state'] else '⚫ OFF'}
+            </div>""",
+        INDEX_BUTTONS,
+        f"""            <p class="time">Last updated: {led['last_updated'] or 'Never'}</p>""",
+        INDEX_TAIL
+    )).encode()
+
+def render_led():
+    """GET /led body for the current state (call with gpio_lock held)"""
+    led = device_info(default_device)
+    return json.dumps({
+        'state': led['state'],
+        'is_on': led['is_on'],
+        'brightness': led['brightness'],
+        'last_updated': led['last_updated'],
+        'gpio_available': GPIO_AVAILABLE
+    }).encode()
+
+def conditional_response(etag, body, mimetype):
+    """Body with an ETag, or an empty 304 if the client already has it"""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+def cached_response(key, render, mimetype):
+    """Serve a body rendered once per state version"""
+    cached = response_cache.get(key)
+    if cached is None or cached[0] != state_version:
+        with gpio_lock:
+            cached = response_cache[key] = (state_version, f"{ETAG_PREFIX}-{key}-{state_version}", render())
+    return conditional_response(cached[1], cached[2], mimetype)
+
+# Routes
+@app.route('/')
+def index():
+    """Web interface"""
+    return cached_response('index', render_index, 'text/html')
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Health check endpoint (quick response)"""
+    return conditional_response(HEALTH_ETAG, HEALTH_BODY, 'application/json')
 
 @app.route('/led', methods=['GET'])
 def get_led():
     """Get current LED state"""
-    return jsonify({
-        'state': 'ON' if led_state else 'OFF',
-        'is_on': led_state,
-        'last_updated': last_updated,
-        'gpio_available': GPIO_AVAILABLE
-    })
+    return cached_response('led', render_led, 'application/json')
 
 @app.route('/led', methods=['POST'])
 def post_led():
@@ -226,24 +829,124 @@ def post_led():
     except Exception:
         return jsonify({'error': 'Invalid JSON'}), 400
     
-    if not data or 'state' not in data:
+    if not isinstance(data, dict):
         return jsonify({'error': 'Missing "state" field'}), 400
     
-    state_str = str(data['state']).upper()
-    
-    if state_str not in ['ON', 'OFF']:
-        return jsonify({'error': 'State must be "ON" or "OFF"'}), 400
+    try:
+        command = parse_command(default_device, data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    new_state = state_str == 'ON'
-    set_led(new_state)
+    info, results = submit_commands({default_device: command})
+    led = info[default_device]
     
     return jsonify({
         'success': True,
-        'state': 'ON' if led_state else 'OFF',
-        'is_on': led_state,
-        'last_updated': last_updated
+        'result': results[default_device],
+        'state': led['state'],
+        'is_on': led['is_on'],
+        'brightness': led['brightness'],
+        'last_updated': led['last_updated']
     })
 
+@app.route('/devices', methods=['GET'])
+def get_devices():
+    """State of every registered device"""
+    with gpio_lock:
+        states = [device_info(name) for name in devices]
+    return jsonify({'devices': states, 'gpio_available': GPIO_AVAILABLE})
+
+@app.route('/devices/<name>', methods=['GET'])
+def get_device(name):
+    """State of one device, with the brightness driven right now"""
+    if name not in devices:
+        return jsonify({'error': f'Unknown device "{name}"'}), 404
+    with gpio_lock:
+        device = devices[name]
+        level = fade_level(device['fade'], time.monotonic()) if device['fade'] else device['level']
+        return jsonify(dict(device_info(name), level=round(level, 1)))
+
+@app.route('/devices/<name>', methods=['POST'])
+def post_device(name):
+    """Set one device"""
+    if name not in devices:
+        return jsonify({'error': f'Unknown device "{name}"'}), 404
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Missing "state" field'}), 400
+    try:
+        command = parse_command(name, data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    info, results = submit_commands({name: command})
+    return jsonify(dict(info[name], success=True, result=results[name]))
+
+@app.route('/devices/batch', methods=['POST'])
+def post_devices_batch():
+    """Set many devices at once
+    
+    Every change is validated first; if any is invalid nothing is applied.
+    The rest are written together under one lock acquisition.
+    """
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict) or not ('devices' in data or 'all' in data):
+        return jsonify({'error': 'Expected "devices" and/or "all"'}), 400
+    
+    changes = {}
+    if 'all' in data:
+        if parse_state(data['all']) is None:
+            return jsonify({'error': '"all" must be "ON" or "OFF"'}), 400
+        changes = {name: parse_command(name, data['all']) for name in devices}
+    
+    requested = data.get('devices', {})
+    if not isinstance(requested, dict):
+        return jsonify({'error': '"devices" must map device names to "ON"/"OFF" or commands'}), 400
+    unknown = [name for name in requested if name not in devices]
+    if unknown:
+        return jsonify({'error': 'Unknown devices', 'devices': unknown}), 404
+    for name, value in requested.items():
+        try:
+            changes[name] = parse_command(name, value)
+        except ValueError as e:
+            return jsonify({'error': f'{name}: {e}'}), 400
+    
+    if not changes:
+        return jsonify({'success': True, 'devices': {}, 'results': {}})
+    info, results = submit_commands(changes)
+    return jsonify({'success': True, 'devices': info, 'results': results})
+
+@app.route('/events', methods=['GET'])
+def get_events():
+    """Long-poll: wait until the state changes after ?since=<version>"""
+    since, timeout = event_args(request.args, request.headers)
+    with state_changed:
+        if since is not None:
+            state_changed.wait_for(lambda: state_version != since, timeout)
+        return jsonify({'version': state_version, 'events': changes_since(since)})
+
+@app.route('/events/stream', methods=['GET'])
+def events_stream():
+    """Server-Sent Events: every change, resuming after Last-Event-ID
+    
+    Holds a server thread per subscriber; use --async for many subscribers.
+    """
+    since, _ = event_args(request.args, request.headers)
+    
+    def generate(version):
+        while True:
+            with state_changed:
+                state_changed.wait_for(lambda: state_version != version, EVENT_KEEPALIVE)
+                events = changes_since(version)
+                version = state_version
+            if not events:
+                yield b': keep-alive\n\n'
+            for event in events:
+                yield sse_event(event)
+    
+    return Response(generate(since), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # Handle OPTIONS preflight requests
 @app.before_request
 def handle_preflight():
@@ -251,21 +954,94 @@ def handle_preflight():
         response = app.make_default_options_response()
         return response
 
+admission = AdmissionControl(RATE_LIMITS, PRIORITY_PATHS, ['/events*'],
+                             max_streams=MAX_SUBSCRIBERS, max_requests=MAX_ACTIVE_REQUESTS)
+
+def create_async_server(threads=4):
+    """Build the asyncio server for --async mode
+    
+    The change feed is served from the event loop, so idle subscribers cost
+    a socket each instead of a thread.
+    """
+    server = AsyncServer(app, threads=threads, admission=admission,
+                         default_headers={'Access-Control-Allow-Origin': '*'})
+    
+    @server.route('/events')
+    async def events_poll(req):
+        since, timeout = event_args(req.args, req.headers)
+        deadline = time.monotonic() + timeout
+        while since is not None and state_version == since:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            waiter = state_signal.waiter()
+            if state_version != since:
+                break
+            await state_signal.wait(remaining, waiter)
+        with gpio_lock:
+            return AsyncResponse.json({'version': state_version, 'events': changes_since(since)})
+    
+    async def event_stream(version):
+        while True:
+            waiter = state_signal.waiter()
+            with gpio_lock:
+                events = changes_since(version)
+                version = state_version
+            for event in events:
+                yield sse_event(event)
+            if not events and not await state_signal.wait(EVENT_KEEPALIVE, waiter):
+                yield b': keep-alive\n\n'
+    
+    @server.route('/events/stream')
+    async def events_sse(req):
+        since, _ = event_args(req.args, req.headers)
+        return AsyncResponse(event_stream(since), content_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    
+    return server
+
+def handle_sigterm(signum, frame):
+    """Stop the development server like Ctrl+C, so cleanup still runs"""
+    raise KeyboardInterrupt
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SmartHome LED Server')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='production mode: asyncio server with keep-alive and a fixed thread pool')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='worker threads for regular requests in --async mode')
+    parser.add_argument('--mock', action='store_true', help='do not touch GPIO even on a Raspberry Pi')
+    parser.add_argument('--no-journal', action='store_true', help='do not restore or save state')
+    args = parser.parse_args()
+    
+    if args.mock:
+        GPIO_AVAILABLE = False
+        HEALTH_BODY = render_health()
+    if args.no_journal:
+        STATE_JOURNAL = None
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    
     try:
+        restore_state()
         setup_gpio()
+        open_journal()
         logger.info("Starting SmartHome LED Server on port 8080...")
-        logger.info("Server is multi-threaded for better performance")
-        
-        # Run with threading enabled for better concurrent handling
-        app.run(
-            host='0.0.0.0', 
-            port=8080, 
-            debug=False,
-            threaded=True,  # Enable multi-threading!
-            use_reloader=False
-        )
+        if args.use_async:
+            create_async_server(args.threads).run('0.0.0.0', 8080)
+        else:
+            logger.info("Server is multi-threaded for better performance")
+            install_flask(admission, app)
+            
+            # Run with threading enabled for better concurrent handling
+            app.run(
+                host='0.0.0.0', 
+                port=8080, 
+                debug=False,
+                threaded=True,  # Enable multi-threading!
+                use_reloader=False
+            )
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     finally:
+        close_journal()
         cleanup_gpio()
@@ -9,8 +9,15 @@ for any schedules that need to be executed.
 Requirements:
     pip install firebase-admin requests
 
+Schedules are kept in an index ordered by their next fire time; the checker
+sleeps until the next one is due instead of checking every minute. The last
+synced schedules are saved to disk, so they keep running without internet
+and right after a restart, and executed occurrences are recorded in a small
+SQLite ledger, so a restart never runs one twice.
+
 Usage:
-    python schedule_checker.py
+    python schedule_checker.py                  # follow changes as they happen
+    python schedule_checker.py --sync poll      # download everything every minute
 
 Setup:
     1. Download Firebase Admin SDK credentials from Firebase Console
@@ -19,11 +26,19 @@ Setup:
     4. Run the script
 """
 
+import argparse
+import heapq
+import itertools
 import time
 import json
 import os
-from datetime import datetime
+import random
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
 
 # Try to import Firebase Admin SDK
 try:
@@ -37,13 +52,35 @@ except ImportError:
 # Configuration
 FIREBASE_DATABASE_URL = "https://iot-project-4b70e-default-rtdb.asia-southeast1.firebasedatabase.app"
 LED_SERVER_URL = "http://localhost:8080"
-CHECK_INTERVAL = 60  # seconds
+CHECK_INTERVAL = 60  # seconds between downloads in --sync poll mode
+MAX_SLEEP = 60  # seconds; wake at least this often to notice clock changes (NTP at boot)
+CATCH_UP_WINDOW = 300  # seconds; triggers missed by more than this are skipped
+DISPATCH_WORKERS = 4  # concurrent requests to the LED server
+RETRY_ATTEMPTS = 3
+RETRY_DELAY = 0.5  # seconds, doubled after every failed attempt
+SYNC_TIMEOUT = 15  # seconds to wait for the first copy of the schedules at startup
+STREAM_TIMEOUT = 90  # Firebase sends a keep-alive every 30s; reconnect if nothing arrives
+RECONNECT_MIN = 1  # seconds, doubled after every failed attempt
+RECONNECT_MAX = 60
 
 # Firebase credentials file path
 CREDENTIALS_FILE = os.path.join(os.path.dirname(__file__), "firebase-credentials.json")
 
-# Track executed schedules to avoid re-execution
-executed_schedules = {}
+# Last synced schedules, loaded at startup (None to disable)
+SNAPSHOT_FILE = os.path.join(os.path.dirname(__file__), "schedules.snapshot.json")
+SNAPSHOT_INTERVAL = 5  # seconds; changes are saved at most this often
+
+# Occurrences already executed (None keeps them in memory only)
+LEDGER_FILE = os.path.join(os.path.dirname(__file__), "schedules.ledger.db")
+LEDGER_RETENTION = 2 * 24 * 3600  # seconds; older entries can never fire again
+LEDGER_EVICT_INTERVAL = 3600  # seconds between deleting expired entries
+
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+# Keep-alive connections to the LED server, shared by all dispatch threads
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_maxsize=DISPATCH_WORKERS))
+session.mount('https://', HTTPAdapter(pool_maxsize=DISPATCH_WORKERS))
 
 
 def init_firebase():
@@ -68,154 +105,637 @@ def init_firebase():
         return False
 
 
-def get_schedules_rest():
-    """Fetch schedules using REST API (requires public read rules)"""
-    try:
-        # This only works with public rules or with auth token
-        url = f"{FIREBASE_DATABASE_URL}/schedules.json"
-        response = requests.get(url, timeout=10)
+def flatten_schedules(data):
+    """{uid: {schedule_id: schedule}} -> list of schedules with 'id' and 'uid' set"""
+    all_schedules = []
+    for uid, schedules in (data or {}).items():
+        if isinstance(schedules, dict):
+            for schedule_id, schedule in schedules.items():
+                if isinstance(schedule, dict):
+                    schedule['id'] = schedule_id
+                    schedule['uid'] = uid
+                    all_schedules.append(schedule)
+    return all_schedules
+
+
+def fetch_schedules_rest(etag=None):
+    """Download the /schedules tree using REST API (requires public read rules)
+    
+    Returns (changed, tree, etag); nothing is downloaded if the tree still
+    matches `etag`.
+    """
+    # This only works with public rules or with auth token
+    url = f"{FIREBASE_DATABASE_URL}/schedules.json"
+    headers = {'X-Firebase-ETag': 'true'}
+    if etag:
+        headers['If-None-Match'] = etag
+    response = requests.get(url, headers=headers, timeout=10)
+    if response.status_code == 304:
+        return False, None, etag
+    response.raise_for_status()
+    return True, response.json(), response.headers.get('ETag')
+
+
+def fetch_schedules_sdk(etag=None):
+    """Download the /schedules tree using Firebase Admin SDK, like
+    fetch_schedules_rest()"""
+    ref = db.reference('schedules')
+    if etag:
+        return ref.get_if_changed(etag)
+    tree, etag = ref.get(etag=True)
+    return True, tree, etag
+
+
+def poll_schedules(mirror, fetch):
+    """Keep `mirror` in sync by downloading everything every CHECK_INTERVAL
+    (or only checking the ETag, when nothing changed)"""
+    while True:
+        try:
+            changed, tree, etag = fetch(mirror.etag)
+            if changed:
+                apply_event(mirror, 'put', '/', tree)
+            elif not mirror.connected:
+                mirror.connected = True
+                print("🔌 Connected to Firebase (schedules unchanged)")
+                mirror.synced.set()
+            mirror.etag = etag
+        except Exception as e:
+            if mirror.connected:
+                mirror.connected = False
+                print(f"📴 Offline, running the last {len(mirror.schedules)} schedules")
+            print(f"❌ Failed to fetch schedules: {e}")
+        time.sleep(CHECK_INTERVAL)
+
+
+def set_path(node, parts, value):
+    """Copy of `node` with `value` stored at `parts`, Firebase style:
+    None deletes, and parents left empty disappear"""
+    if not parts:
+        return value
+    key = parts[0]
+    if isinstance(node, list) and key.isdigit():
+        items = list(node)
+        index = int(key)
+        items.extend([None] * (index + 1 - len(items)))
+        items[index] = set_path(items[index], parts[1:], value)
+        while items and items[-1] is None:
+            items.pop()
+        return items or None
+    node = dict(node) if isinstance(node, dict) else {}
+    child = set_path(node.get(key), parts[1:], value)
+    if child is None:
+        node.pop(key, None)
+    else:
+        node[key] = child
+    return node or None
+
+
+class ScheduleMirror:
+    """In-memory copy of /schedules, kept current by put/patch events
+    
+    Schedules are stored flat, keyed by (uid, schedule id), so an event only
+    touches the schedules under its path. Stored schedules are never modified
+    in place, so lists returned by values() stay consistent.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.schedules = {}
+        self.version = 0  # bumped by every event that changes something
+        self.etag = None  # Firebase ETag of the whole tree, if known
+        self.changes = set()  # keys changed since the last take_changes()
+        self.changed = threading.Condition(self.lock)
+        self.synced = threading.Event()  # a full copy has arrived
+        self.connected = False
+    
+    def values(self):
+        with self.lock:
+            return list(self.schedules.values())
+    
+    def tree(self):
+        """The schedules as a /schedules tree"""
+        with self.lock:
+            tree = {}
+            for (uid, schedule_id), schedule in self.schedules.items():
+                tree.setdefault(uid, {})[schedule_id] = {
+                    k: v for k, v in schedule.items() if k not in ('id', 'uid')}
+            return tree
+    
+    def take_changes(self, timeout):
+        """Wait up to `timeout` seconds for changes, then return them as
+        [(key, schedule or None if it was deleted)]"""
+        with self.lock:
+            if not self.changes:
+                self.changed.wait(timeout)
+            changes, self.changes = self.changes, set()
+            return [(key, self.schedules.get(key)) for key in changes]
+    
+    def apply(self, event, path, data):
+        """Apply a put/patch event at `path` (relative to /schedules),
+        returns the keys of the schedules it changed"""
+        parts = [part for part in path.split('/') if part]
+        with self.lock:
+            if event == 'patch':
+                changed = set()
+                for key, value in (data or {}).items():
+                    changed |= self._put(parts + [part for part in key.split('/') if part], value)
+            else:
+                changed = self._put(parts, data)
+            if changed:
+                self.version += 1
+                self.etag = None
+                self.changes |= changed
+                self.changed.notify_all()
+        return changed
+    
+    def _put(self, parts, data):
+        if len(parts) < 2:
+            # The whole tree (initial sync, resync after a reconnect) or one user:
+            # compare with what we have so only real differences count as changes
+            old = {key: schedule for key, schedule in self.schedules.items()
+                   if not parts or key[0] == parts[0]}
+            tree = {parts[0]: data} if parts else data
+            new = {(s['uid'], s['id']): s for s in flatten_schedules(tree)}
+            changed = {key for key in old.keys() | new.keys() if old.get(key) != new.get(key)}
+            for key in changed:
+                if key in new:
+                    self.schedules[key] = new[key]
+                else:
+                    del self.schedules[key]
+            return changed
         
-        if response.status_code == 200:
-            data = response.json()
-            if data:
-                # Flatten nested structure
-                all_schedules = []
-                for uid, schedules in data.items():
-                    if schedules:
-                        for schedule_id, schedule in schedules.items():
-                            schedule['id'] = schedule_id
-                            schedule['uid'] = uid
-                            all_schedules.append(schedule)
-                return all_schedules
-        return []
-    except Exception as e:
-        print(f"❌ REST API error: {e}")
-        return []
+        key = (parts[0], parts[1])
+        current = self.schedules.get(key)
+        fields = {k: v for k, v in (current or {}).items() if k not in ('id', 'uid')}
+        fields = set_path(fields, parts[2:], data)
+        if not isinstance(fields, dict):
+            fields = None
+        schedule = dict(fields, id=key[1], uid=key[0]) if fields else None
+        if schedule == current:
+            return set()
+        if schedule is None:
+            del self.schedules[key]
+        else:
+            self.schedules[key] = schedule
+        return {key}
+
 
+def apply_event(mirror, event, path, data):
+    """Apply a put/patch event from either listener"""
+    changed = mirror.apply(event, path, data)
+    if not mirror.connected:
+        mirror.connected = True
+        print(f"🔌 Connected to Firebase ({len(mirror.schedules)} schedules)")
+    elif changed:
+        print(f"📝 {len(changed)} schedule(s) changed ({event} {path})")
+    if event == 'put' and path == '/':
+        mirror.synced.set()
 
-def get_schedules_sdk():
-    """Fetch schedules using Firebase Admin SDK"""
+
+def save_snapshot(mirror):
+    """Write the mirror to SNAPSHOT_FILE (atomically, so a crash keeps the old one)"""
+    snapshot = {
+        'version': mirror.version,
+        'etag': mirror.etag,
+        'saved': datetime.now().isoformat(timespec='seconds'),
+        'schedules': mirror.tree()
+    }
+    temp_file = SNAPSHOT_FILE + '.tmp'
     try:
-        ref = db.reference('schedules')
-        data = ref.get()
-        
-        if data:
-            all_schedules = []
-            for uid, schedules in data.items():
-                if schedules:
-                    for schedule_id, schedule in schedules.items():
-                        schedule['id'] = schedule_id
-                        schedule['uid'] = uid
-                        all_schedules.append(schedule)
-            return all_schedules
-        return []
-    except Exception as e:
-        print(f"❌ Firebase SDK error: {e}")
-        return []
+        with open(temp_file, 'w') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(temp_file, SNAPSHOT_FILE)
+        return True
+    except OSError as e:
+        print(f"❌ Failed to save schedules: {e}")
+        return False
 
 
-def control_led(action):
-    """Send command to LED server"""
+def load_snapshot(mirror):
+    """Fill the mirror from SNAPSHOT_FILE, True if there was one"""
     try:
-        response = requests.post(
-            f"{LED_SERVER_URL}/led",
-            json={"state": action},
-            timeout=5
-        )
-        return response.status_code == 200
-    except Exception as e:
-        print(f"❌ LED control error: {e}")
+        with open(SNAPSHOT_FILE) as f:
+            snapshot = json.load(f)
+        mirror.apply('put', '/', snapshot['schedules'])
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"⚠️  Ignoring unreadable {SNAPSHOT_FILE}: {e}")
         return False
+    mirror.version = snapshot.get('version', 0)
+    mirror.etag = snapshot.get('etag')
+    print(f"💾 Loaded {len(mirror.schedules)} schedules saved {snapshot.get('saved')}")
+    return True
+
+
+def read_events(response):
+    """Yield (event, data) from a text/event-stream response as they arrive"""
+    event, data, pending = None, [], []
+    # chunk_size=None yields each chunk as it arrives (on urllib3 1.x and 2.x)
+    for chunk in response.iter_content(chunk_size=None):
+        if b'\n' not in chunk:
+            # The initial put can be megabytes on one line, don't re-split it
+            pending.append(chunk)
+            continue
+        lines = (b''.join(pending) + chunk).split(b'\n')
+        pending = [lines.pop()]
+        for line in lines:
+            line = line.rstrip(b'\r').decode('utf-8')
+            if not line:
+                if event or data:
+                    yield event or 'message', '\n'.join(data)
+                event, data = None, []
+            elif not line.startswith(':'):
+                field, _, value = line.partition(':')
+                value = value[1:] if value.startswith(' ') else value
+                if field == 'event':
+                    event = value
+                elif field == 'data':
+                    data.append(value)
+
+
+def listen_rest(mirror):
+    """Keep `mirror` in sync with the REST event stream, reconnecting forever
+    
+    Every (re)connect starts with a put of the whole tree, which resyncs
+    anything missed while disconnected.
+    """
+    url = f"{FIREBASE_DATABASE_URL}/schedules.json"
+    delay = RECONNECT_MIN
+    while True:
+        try:
+            with requests.get(url, headers={'Accept': 'text/event-stream'}, stream=True,
+                              timeout=(10, STREAM_TIMEOUT)) as response:
+                response.raise_for_status()
+                for event, data in read_events(response):
+                    if event in ('put', 'patch'):
+                        message = json.loads(data)
+                        apply_event(mirror, event, message['path'], message['data'])
+                        delay = RECONNECT_MIN
+                    elif event == 'cancel':
+                        raise RuntimeError(f"stream cancelled by the server: {data}")
+                    elif event == 'auth_revoked':
+                        break
+                    # 'keep-alive' only resets the read timeout
+        except Exception as e:
+            print(f"❌ Schedule stream error: {e}")
+        mirror.connected = False
+        print(f"🔄 Reconnecting schedule stream in {delay}s")
+        time.sleep(delay * random.uniform(1, 1.5))
+        delay = min(delay * 2, RECONNECT_MAX)
+
+
+def listen_sdk(mirror):
+    """Keep `mirror` in sync with an Admin SDK listener (which reconnects
+    and resyncs by itself)"""
+    def on_event(event):
+        apply_event(mirror, event.event_type, event.path, event.data)
+    
+    return db.reference('schedules').listen(on_event)
+
+
+def led_command(action, brightness=None, fade_minutes=None):
+    """Body of a POST /led (brightness/fade need a pwm LED)"""
+    command = {"state": action}
+    if brightness is not None:
+        command["brightness"] = brightness
+    if fade_minutes:
+        command["duration"] = fade_minutes * 60
+    return command
+
+
+def post_command(path, command):
+    """POST a command to the LED server, retrying connection errors and
+    5xx/429 answers with backoff; True if it was accepted"""
+    delay = RETRY_DELAY
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            response = session.post(f"{LED_SERVER_URL}{path}", json=command, timeout=5)
+            if response.status_code == 200:
+                return True
+            error = f"HTTP {response.status_code}: {response.text.strip()}"
+            if response.status_code < 500 and response.status_code != 429:
+                break  # The command itself was rejected, sending it again won't help
+        except Exception as e:
+            error = e
+        if attempt + 1 < RETRY_ATTEMPTS:
+            time.sleep(delay)
+            delay *= 2
+    print(f"❌ LED control error: {error}")
+    return False
 
 
-def get_current_time():
-    """Get current time as HH:MM string"""
-    return datetime.now().strftime("%H:%M")
+def control_led(action, brightness=None, fade_minutes=None):
+    """Send command to LED server (brightness/fade need a pwm LED)"""
+    return post_command('/led', led_command(action, brightness, fade_minutes))
 
 
-def get_current_day():
-    """Get current day as short name (Mon, Tue, etc.)"""
-    days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-    return days[datetime.now().weekday()]
+class Dispatcher:
+    """Sends the commands of due schedules without blocking the main loop
+    
+    Commands for different targets run in parallel on DISPATCH_WORKERS
+    threads. Commands for the same target are sent in order, batch after
+    batch, because the last one decides the final state. Schedules due
+    together with the same command share one request.
+    """
+    
+    def __init__(self, ledger, workers=DISPATCH_WORKERS):
+        self.ledger = ledger
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dispatch')
+        self.last_batch = {}  # path -> Future of the last batch sent to it
+    
+    def dispatch(self, due):
+        """Send the commands for `due`, a list of (fire time, schedule)"""
+        targets = {}  # path -> {command: [(fire time, schedule)]}, in sending order
+        for fire_time, schedule in due:
+            command = led_command(schedule.get('action', 'OFF'), schedule.get('brightness'),
+                                  schedule.get('fadeMinutes'))
+            key = json.dumps(command, sort_keys=True)
+            commands = targets.setdefault('/led', {})
+            # A repeated command moves to the end: it is the one that must win
+            commands[key] = commands.pop(key, []) + [(fire_time, schedule)]
+        for path, commands in targets.items():
+            previous = self.last_batch.get(path)
+            self.last_batch[path] = self.executor.submit(self.run, path, commands, previous)
+    
+    def run(self, path, commands, previous):
+        if previous is not None:
+            previous.result()  # Submitted earlier, so it already has a thread
+        for key, schedules in commands.items():
+            command = json.loads(key)
+            count = f" ({len(schedules)} schedules)" if len(schedules) > 1 else ""
+            if post_command(path, command):
+                print(f"   ✅ LED turned {command['state']}{count}")
+                self.ledger.mark_executed([((schedule['uid'], schedule['id']), fire_time)
+                                           for fire_time, schedule in schedules])
+            else:
+                print(f"   ❌ Failed to control LED{count}")
+    
+    def close(self):
+        """Wait for the commands already dispatched"""
+        self.executor.shutdown(wait=True)
 
 
-def should_execute(schedule, current_time, current_day):
-    """Check if schedule should be executed now"""
+def next_fire(schedule, after):
+    """First time after `after` (a datetime) the schedule fires, None if never"""
     if not schedule.get('enabled', True):
-        return False
+        return None
+    try:
+        hour, minute = map(int, str(schedule.get('time')).split(':'))
+        fire = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    except ValueError:
+        return None
     
-    if schedule.get('time') != current_time:
-        return False
+    repeat = schedule.get('repeat') or []
+    if isinstance(repeat, dict):
+        repeat = list(repeat.values())
+    days = {DAYS.index(day) for day in repeat if day in DAYS}
+    if repeat and not days:
+        return None
     
-    repeat = schedule.get('repeat', [])
+    # If no repeat days, it's a one-time schedule: it may fire on any day
+    for _ in range(8):
+        if fire > after and (not days or fire.weekday() in days):
+            return fire
+        fire += timedelta(days=1)
+    return None
+
+
+class ScheduleIndex:
+    """Schedules ordered by next fire time
     
-    # If no repeat days, it's a one-time schedule
-    if not repeat:
-        # Check if already executed today
-        schedule_id = schedule.get('id')
-        today = datetime.now().strftime("%Y-%m-%d")
-        if executed_schedules.get(schedule_id) == today:
-            return False
-        return True
+    A heap of (fire time, sequence, key); entries replaced by update() are
+    left in the heap and skipped when they surface, so changing one schedule
+    costs O(log n) however many there are.
+    """
+    
+    def __init__(self):
+        self.heap = []
+        self.entries = {}  # key -> (fire time, sequence, schedule)
+        self.last_fired = {}  # key -> last occurrence returned by pop_due()
+        self.sequence = itertools.count()
+    
+    def __len__(self):
+        return len(self.entries)
     
-    # Check if current day is in repeat list
-    return current_day in repeat
+    def update(self, key, schedule, after):
+        """Add, change (or with schedule=None remove) a schedule; it next
+        fires after `after`, and never twice for the same occurrence"""
+        if schedule is None:
+            self.entries.pop(key, None)
+            self.last_fired.pop(key, None)
+            return
+        fire = next_fire(schedule, max(after, self.last_fired.get(key, after)))
+        if fire is None:
+            self.entries.pop(key, None)
+            return
+        sequence = next(self.sequence)
+        self.entries[key] = (fire, sequence, schedule)
+        heapq.heappush(self.heap, (fire, sequence, key))
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            # Mostly stale entries, rebuild
+            self.heap = [(fire, sequence, key) for key, (fire, sequence, _) in self.entries.items()]
+            heapq.heapify(self.heap)
+    
+    def _is_current(self, item):
+        entry = self.entries.get(item[2])
+        return entry is not None and entry[1] == item[1]
+    
+    def next_time(self):
+        """When the next schedule fires, None if nothing is scheduled"""
+        while self.heap and not self._is_current(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+    
+    def pop_due(self, now):
+        """[(fire time, schedule)] of every occurrence up to `now`, oldest
+        first; each schedule is moved on to its following occurrence"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            item = heapq.heappop(self.heap)
+            if not self._is_current(item):
+                continue
+            fire, _, key = item
+            schedule = self.entries[key][2]
+            self.last_fired[key] = fire
+            due.append((fire, schedule))
+            self.update(key, schedule, fire)
+        return due
 
 
-def mark_executed(schedule_id):
-    """Mark schedule as executed today"""
-    today = datetime.now().strftime("%Y-%m-%d")
-    executed_schedules[schedule_id] = today
+class ExecutionLedger:
+    """Occurrences already executed, keyed by (uid, schedule id, fire time)
+    
+    Kept in SQLite so they survive restarts; each dispatched batch is one
+    transaction, and entries older than LEDGER_RETENTION are deleted, so
+    the file stays the same size over months.
+    """
+    
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS executed ('
+                        'uid TEXT, schedule_id TEXT, fire_time INTEGER, '
+                        'PRIMARY KEY (uid, schedule_id, fire_time)) WITHOUT ROWID')
+        self.last_evict = 0
+        self.evict()
+    
+    def was_executed(self, key, fire_time):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT 1 FROM executed WHERE uid = ? AND schedule_id = ? AND fire_time = ?',
+                (key[0], key[1], int(fire_time.timestamp()))).fetchone()
+        return row is not None
+    
+    def mark_executed(self, occurrences):
+        """Record [(key, fire time)] in one transaction"""
+        rows = [(key[0], key[1], int(fire_time.timestamp())) for key, fire_time in occurrences]
+        try:
+            with self.lock, self.db:
+                self.db.executemany('INSERT OR IGNORE INTO executed VALUES (?, ?, ?)', rows)
+        except sqlite3.Error as e:
+            print(f"❌ Failed to record executed schedules: {e}")
+        if time.monotonic() - self.last_evict > LEDGER_EVICT_INTERVAL:
+            self.evict()
+    
+    def evict(self):
+        """Delete entries too old to fire again"""
+        self.last_evict = time.monotonic()
+        try:
+            with self.lock, self.db:
+                self.db.execute('DELETE FROM executed WHERE fire_time < ?',
+                                (int(time.time() - LEDGER_RETENTION),))
+        except sqlite3.Error as e:
+            print(f"❌ Failed to clean up the ledger: {e}")
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
 
 
 def main():
+    global FIREBASE_DATABASE_URL, LED_SERVER_URL, SNAPSHOT_FILE, LEDGER_FILE
+    parser = argparse.ArgumentParser(description='SmartHome IoT Schedule Checker')
+    parser.add_argument('--sync', choices=['stream', 'poll'], default='stream',
+                        help='stream: keep a local copy updated by Firebase events; poll: download all schedules every check')
+    parser.add_argument('--database-url', default=FIREBASE_DATABASE_URL,
+                        help='Firebase Realtime Database URL (or a local fake_firebase.py)')
+    parser.add_argument('--led-url', default=LED_SERVER_URL, help='LED server URL')
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help='do not load or save the last synced schedules')
+    parser.add_argument('--no-ledger', action='store_true',
+                        help='do not remember executed schedules across restarts')
+    args = parser.parse_args()
+    FIREBASE_DATABASE_URL = args.database_url.rstrip('/')
+    LED_SERVER_URL = args.led_url.rstrip('/')
+    if args.no_snapshot:
+        SNAPSHOT_FILE = None
+    if args.no_ledger:
+        LEDGER_FILE = None
+    
     print("=" * 50)
     print("🏠 SmartHome IoT Schedule Checker")
     print("=" * 50)
     print(f"📍 Firebase: {FIREBASE_DATABASE_URL}")
     print(f"💡 LED Server: {LED_SERVER_URL}")
-    print(f"⏰ Check interval: {CHECK_INTERVAL}s")
+    print(f"🔁 Sync: {args.sync}" + (f" (every {CHECK_INTERVAL}s)" if args.sync == 'poll' else ""))
     print()
     
     # Initialize Firebase
     use_sdk = init_firebase()
-    get_schedules = get_schedules_sdk if use_sdk else get_schedules_rest
+    
+    # Checks read a local copy. In stream mode only deltas cross the network,
+    # and the copy keeps its last contents while the stream reconnects
+    mirror = ScheduleMirror()
+    # Start from the saved copy right away; Firebase reconciles it when it answers
+    restored = SNAPSHOT_FILE is not None and load_snapshot(mirror)
+    saved = (mirror.version, mirror.etag) if restored else None
+    if args.sync == 'poll':
+        fetch = fetch_schedules_sdk if use_sdk else fetch_schedules_rest
+        threading.Thread(target=poll_schedules, args=(mirror, fetch), daemon=True).start()
+    elif use_sdk:
+        listen_sdk(mirror)
+    else:
+        threading.Thread(target=listen_rest, args=(mirror,), daemon=True).start()
+    if not restored and not mirror.synced.wait(SYNC_TIMEOUT):
+        print("⚠️  No schedules received yet, continuing while Firebase connects")
     
     print()
     print("🔄 Starting schedule checker loop...")
     print("-" * 50)
     
+    try:
+        ledger = ExecutionLedger(LEDGER_FILE)
+    except sqlite3.Error as e:
+        print(f"⚠️  Cannot open {LEDGER_FILE} ({e}), executed schedules are not remembered")
+        ledger = ExecutionLedger(None)
+    
+    index = ScheduleIndex()
+    dispatcher = Dispatcher(ledger)
+    # The ledger knows what already ran, so the first schedules loaded can also
+    # catch up on triggers missed while the checker was down
+    catch_up_from = None
+    if LEDGER_FILE:
+        catch_up_from = datetime.now() - timedelta(seconds=CATCH_UP_WINDOW)
+    last_save = 0
+    wait = 0
     while True:
         try:
-            current_time = get_current_time()
-            current_day = get_current_day()
+            # Apply changes; anything due earlier in the current minute still fires
+            changes = mirror.take_changes(wait)
+            now = datetime.now()
+            after = now.replace(second=0, microsecond=0) - timedelta(microseconds=1)
+            if catch_up_from is not None:
+                after = min(after, max(catch_up_from, now - timedelta(seconds=CATCH_UP_WINDOW)))
+                if changes and (restored or mirror.synced.is_set()):
+                    catch_up_from = None
+            for key, schedule in changes:
+                index.update(key, schedule, after)
             
-            # Fetch schedules
-            schedules = get_schedules()
+            due = []
+            for fire_time, schedule in index.pop_due(now):
+                action = schedule.get('action', 'OFF')
+                label = fire_time.strftime("%H:%M")
+                
+                if (now - fire_time).total_seconds() > CATCH_UP_WINDOW:
+                    print(f"⏭️  [{label}] Skipping missed schedule: {action}")
+                    continue
+                if ledger.was_executed((schedule['uid'], schedule['id']), fire_time):
+                    continue
+                
+                print(f"⏰ [{label}] Executing schedule: {action}")
+                due.append((fire_time, schedule))
+            if due:
+                dispatcher.dispatch(due)
             
-            # Check each schedule
-            for schedule in schedules:
-                if should_execute(schedule, current_time, current_day):
-                    action = schedule.get('action', 'OFF')
-                    schedule_id = schedule.get('id')
-                    
-                    print(f"⏰ [{current_time}] Executing schedule: {action}")
-                    
-                    if control_led(action):
-                        print(f"   ✅ LED turned {action}")
-                        mark_executed(schedule_id)
-                    else:
-                        print(f"   ❌ Failed to control LED")
+            # Sleep until the next schedule is due (or the mirror changes)
+            next_time = index.next_time()
+            wait = MAX_SLEEP
+            if next_time is not None:
+                wait = min(wait, max(0, (next_time - datetime.now()).total_seconds()))
             
-            # Wait for next check
-            time.sleep(CHECK_INTERVAL)
+            # Save changes, batched so a burst of edits is written once
+            if SNAPSHOT_FILE and (mirror.version, mirror.etag) != saved:
+                save_in = last_save + SNAPSHOT_INTERVAL - time.monotonic()
+                if save_in <= 0:
+                    saved = (mirror.version, mirror.etag)
+                    last_save = time.monotonic()
+                    save_snapshot(mirror)
+                else:
+                    wait = min(wait, save_in)
             
         except KeyboardInterrupt:
+            dispatcher.close()
+            ledger.close()
+            if SNAPSHOT_FILE and (mirror.version, mirror.etag) != saved:
+                save_snapshot(mirror)
             print("\n👋 Schedule checker stopped")
             break
         except Exception as e:
             print(f"❌ Error in main loop: {e}")
-            time.sleep(CHECK_INTERVAL)
+            wait = MAX_SLEEP
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+"""Rate limits and the priority lane of admission.py, on led_server's rules"""
+
+import pytest
+from flask import Flask
+
+import led_server
+from admission import AdmissionControl, install_flask
+
+CLIENT = '192.168.1.20'
+
+
+@pytest.fixture
+def client():
+    """Flask test client of an app with /led and /health behind led_server's limits"""
+    app = Flask(__name__)
+    app.add_url_rule('/led', 'led', lambda: {'state': 'OFF'})
+    app.add_url_rule('/health', 'health', lambda: {'status': 'healthy'})
+    admission = AdmissionControl(led_server.RATE_LIMITS, led_server.PRIORITY_PATHS, ['/events*'])
+    install_flask(admission, app)
+    return app.test_client()
+
+
+def get(client, path, remote_addr=CLIENT):
+    return client.get(path, environ_base={'REMOTE_ADDR': remote_addr})
+
+
+def exhaust(client, path):
+    """Request `path` until rate limited, return the 429 response"""
+    for _ in range(1000):
+        response = get(client, path)
+        if response.status_code == 429:
+            return response
+        assert response.status_code == 200
+    pytest.fail(f'{path} was never rate limited')
+
+
+def test_busy_endpoint_does_not_throttle_health(client):
+    rejected = exhaust(client, '/led')
+    assert int(rejected.headers['Retry-After']) >= 1
+
+    assert get(client, '/health').status_code == 200
+    assert get(client, '/led').status_code == 429
+
+
+def test_limits_are_per_client(client):
+    exhaust(client, '/led')
+    assert get(client, '/led', '192.168.1.21').status_code == 200
+    # Local services are exempt
+    for _ in range(100):
+        assert get(client, '/led', '127.0.0.1').status_code == 200
@@ -0,0 +1,47 @@
+"""The command queue in front of the GPIO layer (mock mode)"""
+
+import threading
+import time
+
+import pytest
+
+import led_server
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(led_server, 'GPIO_AVAILABLE', False)
+    monkeypatch.setattr(led_server, 'devices', led_server.load_devices(str(tmp_path / 'devices.json')))
+    monkeypatch.setattr(led_server, 'last_flush', 0.0)
+    return led_server.app.test_client()
+
+
+def post_led(client, state):
+    """POST /led from another thread, None if it hangs"""
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(client.post('/led', json={'state': state})),
+                              daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+    return responses[0] if responses else None
+
+
+def test_failed_write_answers_queued_requests(client, monkeypatch):
+    assert post_led(client, 'ON').json['result'] == 'applied'
+
+    set_devices = led_server.set_devices
+
+    def fail(commands):
+        raise RuntimeError('GPIO write failed')
+
+    # Arrives within the coalescing window, so it waits for the next flush
+    monkeypatch.setattr(led_server, 'set_devices', fail)
+    response = post_led(client, 'OFF')
+    assert response is not None, 'request hung on a failed flush'
+    assert response.status_code == 500
+    assert not led_server.pending_commands and not led_server.pending_callers
+
+    # The queue is usable again once the GPIO layer recovers
+    monkeypatch.setattr(led_server, 'set_devices', set_devices)
+    time.sleep(led_server.COALESCE_WINDOW)
+    assert post_led(client, 'OFF').json['result'] == 'applied'
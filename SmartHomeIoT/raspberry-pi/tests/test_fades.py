@@ -0,0 +1,108 @@
+"""Fade timing on a mock-mode pwm device (no GPIO)"""
+
+import json
+import time
+
+import pytest
+
+import led_server
+
+TOLERANCE = 0.1  # seconds a fade may end late on a busy test machine
+
+
+@pytest.fixture
+def lamp(tmp_path, monkeypatch):
+    """A pwm device 'lamp' whose every level write is recorded as (time, level)"""
+    config = tmp_path / 'devices.json'
+    config.write_text(json.dumps({'lamp': {'pin': 12, 'mode': 'pwm'}}))
+    monkeypatch.setattr(led_server, 'GPIO_AVAILABLE', False)
+    monkeypatch.setattr(led_server, 'devices', led_server.load_devices(str(config)))
+
+    writes = []
+    write_level = led_server.write_level
+
+    def record(device, level):
+        writes.append((time.monotonic(), level))
+        write_level(device, level)
+
+    monkeypatch.setattr(led_server, 'write_level', record)
+    yield led_server.devices['lamp'], writes
+    # Let the fade thread exit before the next test swaps the devices
+    with led_server.gpio_lock:
+        led_server.devices['lamp']['fade'] = None
+    wait_for_fade_end(led_server.devices['lamp'])
+
+
+def wait_for_fade_end(device, timeout=5):
+    deadline = time.monotonic() + timeout
+    while device['fade'] is not None:
+        assert time.monotonic() < deadline, 'fade did not finish'
+        time.sleep(0.005)
+    return time.monotonic()
+
+
+def assert_monotonic(levels, increasing=True):
+    pairs = list(zip(levels, levels[1:]))
+    if increasing:
+        assert all(a <= b for a, b in pairs)
+    else:
+        assert all(a >= b for a, b in pairs)
+
+
+def test_fade_ends_on_time(lamp):
+    device, writes = lamp
+    start = time.monotonic()
+    led_server.set_devices({'lamp': (100.0, 0.5)})
+    end = wait_for_fade_end(device)
+
+    assert 0.5 <= end - start <= 0.5 + TOLERANCE
+    levels = [level for _, level in writes]
+    assert len(levels) > 10
+    assert all(0 <= level <= 100 for level in levels)
+    assert_monotonic(levels)
+    assert levels[-1] == device['level'] == 100.0
+    assert device['brightness'] == 100.0 and device['state'] is True
+
+
+def test_fade_levels_follow_the_clock(lamp):
+    device, writes = lamp
+    start = time.monotonic()
+    led_server.set_devices({'lamp': (80.0, 0.4)})
+    wait_for_fade_end(device)
+
+    for at, level in writes[:-1]:
+        expected = 80.0 * (at - start) / 0.4
+        assert abs(level - expected) <= 80.0 * TOLERANCE / 0.4
+
+
+def test_retarget_mid_fade(lamp):
+    device, writes = lamp
+    led_server.set_devices({'lamp': (100.0, 1.0)})
+    time.sleep(0.3)
+    retarget = time.monotonic()
+    led_server.set_devices({'lamp': (0.0, 0.3)})
+    end = wait_for_fade_end(device)
+
+    assert 0.3 <= end - retarget <= 0.3 + TOLERANCE
+    before = [level for at, level in writes if at < retarget]
+    after = [level for at, level in writes if at >= retarget]
+    assert_monotonic(before)
+    assert_monotonic(after, increasing=False)
+    # The new fade starts from the current level instead of jumping
+    assert abs(after[0] - before[-1]) < 10
+    assert 0 < max(before) < 100
+    assert device['level'] == 0.0 and device['state'] is False
+
+
+def test_cancel_mid_fade(lamp):
+    device, writes = lamp
+    led_server.set_devices({'lamp': (100.0, 1.0)})
+    time.sleep(0.2)
+    led_server.set_devices({'lamp': (50.0, 0)})
+
+    assert device['fade'] is None
+    assert device['level'] == 50.0
+    count = len(writes)
+    time.sleep(0.2)
+    assert len(writes) == count  # The fade thread wrote nothing more
+    assert device['level'] == 50.0